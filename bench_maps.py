@@ -0,0 +1,225 @@
+#!/usr/bin/python
+
+# Time each phase of read_maps_v2.py over the sample map files
+#  and over copies of them scaled up to a million lines or more.
+# Results are saved as json to compare between revisions:
+#   python bench_maps.py -o before.json
+#   ... change read_maps_v2.py ...
+#   python bench_maps.py -o after.json --compare before.json
+
+### Phases, each timed separately (best of --repeat runs):
+###   read     - read_map_file, the file into lists of section lines
+###   parse    - parse_sections, the lines into a Memory_map
+###   symbols  - make the Symbols of every Region
+###   csv      - export_categories
+###   json     - export_json
+### Each map is run in a fresh process so its peak RSS is its own.
+
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import read_maps_v2 as maps
+
+PHASES = ["read", "parse", "symbols", "csv", "json"]
+SAMPLE = "mapfiles/stmhal_firmware_dh_01.map" # scaled up by --lines
+
+###-------------------------------------
+### Scaled maps
+
+def scale_map(source, target, factor):
+    """ Write source to target with the body of every Region
+        in the linker memory map repeated factor times
+        - the other sections are copied as they are
+        - addresses repeat, which the parser does not mind
+        Return lines written
+    """
+    linker = maps.SECTIONS[4]
+    count = 0
+    in_linker = False
+    body = []
+    with open(source) as inf:
+        with open(target, 'w') as outf:
+            for line in inf:
+                if line[:1] == " " and in_linker:
+                    body.append(line)
+                    continue
+                if body:
+                    outf.writelines(body * factor)
+                    count += len(body) * factor
+                    body = []
+                if line.startswith(maps.SECTIONS[5]) or line.startswith(maps.SECTIONS[6]):
+                    in_linker = False
+                elif line.startswith(linker):
+                    in_linker = True
+                outf.write(line)
+                count += 1
+            outf.writelines(body * factor)
+            count += len(body) * factor
+    return count
+
+def line_count(filename):
+    with open(filename) as inf:
+        return sum(1 for line in inf)
+
+def scaled_maps(directory, targets, source=SAMPLE):
+    """ Make a scaled copy of source for each of targets (line counts)
+        Return list of filenames
+    """
+    lines = line_count(source)
+    others = scale_map(source, os.devnull, 0) # lines outside the Region bodies
+    made = []
+    for target in targets:
+        factor = max(1, int(round(float(target - others) / (lines - others))))
+        name = os.path.join(directory, "scaled_%dx_%s" % (factor, os.path.basename(source)))
+        if not os.path.exists(name):
+            scale_map(source, name, factor)
+        made.append(name)
+    return made
+
+###-------------------------------------
+### Timing one map
+
+def best_time(function, repeat):
+    """ shortest wall time of repeat calls of function, printing muted
+        Return time, last result
+    """
+    best = None
+    result = None
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            result = None
+            sys.stdout = devnull
+            try:
+                start = time.time()
+                result = function()
+                taken = time.time() - start
+            finally:
+                sys.stdout = stdout
+            if best is None or taken < best:
+                best = taken
+    return best, result
+
+def make_symbols(memmap):
+    " make the Symbols of every Region of memmap "
+    for block in memmap.blocks:
+        for region in block.regions:
+            region.symbols
+    return memmap
+
+def bench_map(filename, repeat=3):
+    """ Time each of PHASES on filename
+        Return dict of results
+    """
+    size = os.path.getsize(filename)
+    lines = line_count(filename)
+    name = os.path.basename(filename)
+    times = {}
+    times["read"], extracted = best_time(lambda: maps.read_map_file(filename), repeat)
+    times["parse"], memmap = best_time(lambda: maps.parse_sections(extracted, name), repeat)
+    times["symbols"], memmap = best_time(lambda: make_symbols(maps.parse_sections(extracted, name)), repeat)
+    times["symbols"] -= times["parse"]
+    output = tempfile.mktemp(prefix="bench_maps")
+    regionlist = maps.merge_orders([maps.CATS] + memmap.region_orders())
+    try:
+        times["csv"], x = best_time(lambda: maps.export_categories(output, [memmap], regionlist), repeat)
+        times["json"], x = best_time(lambda: maps.export_json(output, [memmap]), repeat)
+    finally:
+        if os.path.exists(output):
+            os.remove(output)
+    symbols = sum(r.symbol_count() for b in memmap.blocks for r in b.regions)
+    result = {"file": filename, "bytes": size, "lines": lines, "symbols": symbols,
+              "seconds": times,
+              # ru_maxrss is KB on Linux
+              "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+    for phase in ("read", "parse"):
+        taken = times[phase] or 1e-9
+        result[phase + "_lines_per_s"] = lines / taken
+        result[phase + "_mb_per_s"] = size / taken / (1024 * 1024)
+    return result
+
+def bench_in_process(filename, repeat):
+    """ bench_map in a fresh python process
+        - so peak RSS is for this map alone
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--worker", "--repeat", str(repeat), filename]
+    output = subprocess.check_output(command)
+    return json.loads(output.splitlines()[-1])
+
+###-------------------------------------
+### Reports
+
+def revision():
+    " git revision of the tree being timed, or None "
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                           stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def describe(results, reference=None):
+    """ print a table of results
+        - reference: results of an earlier run, shown as time ratios (new/old)
+    """
+    old = dict((os.path.basename(r["file"]), r) for r in reference["maps"]) if reference else {}
+    print "%-40s %8s %7s " % ("map", "lines", "rss MB") + " ".join("%9s" % p for p in PHASES) + "  read lines/s  parse MB/s"
+    for r in results["maps"]:
+        name = os.path.basename(r["file"])
+        print "%-40s %8d %7.1f " % (name[-40:], r["lines"], r["peak_rss_mb"]) + \
+              " ".join("%7.1fms" % (1000 * r["seconds"][p]) for p in PHASES) + \
+              "  %12d  %10.2f" % (r["read_lines_per_s"], r["parse_mb_per_s"])
+        if name in old:
+            was = old[name]["seconds"]
+            print "%-40s %8s %7s " % ("  vs " + (reference.get("revision") or "reference"), "", "") + \
+                  " ".join("%8.2fx" % (r["seconds"][p] / (was[p] or 1e-9)) for p in PHASES if p in was)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time each phase of read_maps_v2 on map files")
+    parser.add_argument("paths", nargs="*", default=["mapfiles"],
+                        help="map files, globs or directories (default mapfiles)")
+    parser.add_argument("--lines", type=int, nargs="*", default=[100000, 1000000],
+                        help="also time %s scaled to about these line counts" % SAMPLE)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of each phase, the best is kept (default 3)")
+    parser.add_argument("--scaled-dir", default=tempfile.gettempdir(),
+                        help="where the scaled maps are written (default %s)" % tempfile.gettempdir())
+    parser.add_argument("-o", "--output", default=None,
+                        help="save the results as json")
+    parser.add_argument("--compare", metavar="JSON", default=None,
+                        help="results of an earlier run to compare with")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    #
+    if args.worker:
+        for filename in args.paths:
+            print json.dumps(bench_map(filename, args.repeat))
+        return
+    files = maps.find_map_files(args.paths)
+    if args.lines:
+        files.extend(scaled_maps(args.scaled_dir, args.lines))
+    results = {"revision": revision(), "python": sys.version.split()[0],
+               "time": time.strftime("%Y-%m-%d %H:%M:%S"), "repeat": args.repeat,
+               "maps": [bench_in_process(f, args.repeat) for f in files]}
+    reference = None
+    if args.compare:
+        with open(args.compare) as inf:
+            reference = json.load(inf)
+    describe(results, reference)
+    if args.output:
+        with open(args.output, 'w') as outf:
+            json.dump(results, outf, indent=1, sort_keys=True)
+        print "Saved to", args.output
+
+
+###
+if __name__ == "__main__":
+    main()
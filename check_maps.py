@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+# Check read_maps_v2.py against known answers from the sample map files
+#   python check_maps.py
+# Prints each failure and exits 1 if there were any.
+
+### Checks:
+###   resolve  - Address_resolver.resolve of addresses whose
+###              Block, Region, input section, label and file are known
+###   npz      - Symbol_table saved and loaded back unchanged (needs numpy)
+
+
+import os
+import sys
+import tempfile
+
+import read_maps_v2 as maps
+
+### (map file, addr, (block, region, section, label, file))
+RESOLVED = [
+    # vector tables at 0x0, not the merged .rodata.str1.1 listed there
+    ("mapfiles/microbit-micropython_01.map", 0x10,
+     ("FLASH", ".text", ".Vectors", "__Vectors",
+      "ym/mbed-classic/existing/mbed-classic.a(startup_NRF51822.S.obj)")),
+    ("mapfiles/teensy_micropython_dh_01.map", 0x1,
+     ("FLASH", ".text", ".vectors", "gVectors", "build/core/mk20dx128.o")),
+    # a NULL dereference is in no input section
+    ("mapfiles/stmhal_firmware_dh_01.map", 0x1,
+     ("*default*", None, None, None, None)),
+    ("mapfiles/stmhal_firmware_dh_01.map", 0x08001368,
+     ("FLASH_ISR", ".isr_vector", ".text.f_mount", "f_mount", "build-PYBV10/lib/fatfs/ff.o")),
+    ("mapfiles/stmhal_firmware_dh_01.map", 0x080454d8,
+     ("FLASH_TEXT", ".text", ".text", "gc_helper_get_regs_and_clean_stack", "build-PYBV10/gchelper.o")),
+    ("mapfiles/unix_micropython_dh_01.map", 0x10,
+     ("*default*", None, None, None, None)),
+    ]
+
+def check_resolve(symbols=False):
+    """ resolve each of RESOLVED
+        - symbols makes the Symbols first, which must not change the answers
+        Return list of failure messages
+    """
+    failed = []
+    resolvers = {}
+    for filename, addr, expected in RESOLVED:
+        if filename not in resolvers:
+            memmap = maps.parse_map_file(filename, verbose=False)
+            if symbols:
+                for block in memmap.blocks:
+                    for region in block.regions:
+                        region.symbols
+            resolvers[filename] = maps.Address_resolver(memmap)
+        found = resolvers[filename].resolve([addr])[0][1:]
+        if found != expected:
+            failed.append("%s %s: %s, expected %s" % (filename, maps.hex_text(addr), found, expected))
+    return failed
+
+def check_npz(filenames=maps.MAPFILES):
+    """ save the Symbol_table of filenames as .npz and load it back
+        Return list of failure messages
+    """
+    if maps.numpy is None:
+        print "skipped npz, needs numpy"
+        return []
+    table = maps.Symbol_table([maps.parse_map_file(f, verbose=False) for f in filenames])
+    handle, filename = tempfile.mkstemp(suffix=".npz")
+    os.close(handle)
+    try:
+        table.save(filename)
+        loaded = maps.Symbol_table.load(filename)
+    finally:
+        os.remove(filename)
+    failed = []
+    for name in maps.Symbol_table.COLUMNS + ["systems", "blocks", "regions", "files"]:
+        if getattr(loaded, name) != getattr(table, name):
+            failed.append("npz %s differs after loading" % name)
+    if loaded.blob() != table.blob() or loaded.offsets != table.offsets:
+        failed.append("npz names differ after loading")
+    return failed
+
+def main():
+    failed = check_resolve() + check_resolve(symbols=True) + check_npz()
+    for message in failed:
+        print "FAIL", message
+    print "%d failed" % len(failed)
+    sys.exit(1 if failed else 0)
+
+
+###
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/python
+
+# Write synthetic GNU ld .map files, for stress testing read_maps_v2.py
+#  - the same shapes as the sample maps in mapfiles/
+#  - seeded, so the same options always give the same file
+#  - written as generated, so files of many GB need little memory
+#
+#   python gen_map.py -o big.map --symbols 2000000 --objects 20000
+
+### Sections written, in the order ld writes them:
+###   Archive members (Preamble), Allocating common symbols,
+###   Discarded input sections, Memory Configuration,
+###   Linker script and memory map, OUTPUT, Cross Reference Table
+### Regions: .isr_vector, .text (and any extra text Regions) in FLASH
+###          .data (loaded from FLASH), .bss with the COMMON symbols,
+###          .heap and .stack reserved with *fill*, in RAM
+### Input section names longer than 14 characters are split over two
+###  lines as ld does. The split, *fill* and COMMON counts are exact.
+
+
+import argparse
+import random
+import sys
+
+import read_maps_v2 as maps
+
+FLASH = 0x08000000
+RAM = 0x20000000 # or after FLASH, for very large maps
+TEXT_SIZE = 0x100 # largest text input section
+HEAP = 0x4000
+STACK = 0x800
+NAME_WIDTH = 14 # longer input section names go on their own line
+DIRECTORIES = ["build/py", "build/extmod", "build/hal/src", "build/lib/fatfs",
+               "build/drivers", "build/usbdev/class/src", "build"]
+
+###-------------------------------------
+### Names, all made from an index so nothing needs to be kept
+
+def object_name(i, objects, archives):
+    """ path of object file i
+        - the last archives objects are members of lib<n>.a
+    """
+    if i >= objects - archives:
+        member = i - (objects - archives)
+        return "lib/arm/lib%s.a(lib_a-m%x.o)" % ("cgm"[member % 3], member)
+    return "%s/obj%x.o" % (DIRECTORIES[i % len(DIRECTORIES)], i)
+
+def base36(i):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    text = digits[i % 36]
+    while i >= 36:
+        i //= 36
+        text = digits[i % 36] + text
+    return text
+
+def function_name(i, split):
+    " a name short enough to fit after .text., or long enough to split "
+    if split:
+        return "module_function_%x" % i
+    return "f" + base36(i)
+
+def fits(prefix, name):
+    return len(prefix) + len(name) <= NAME_WIDTH
+
+class Chooser(object):
+    """ Pick exactly k of the next n items, at random (selection sampling)
+        - so exact counts can be drawn while streaming
+    """
+    def __init__(self, k, n, rng):
+        self.k = k
+        self.n = n
+        self.rng = rng
+    def __call__(self):
+        " True if this item is picked "
+        picked = self.n > 0 and self.rng.random() * self.n < self.k
+        self.n -= 1
+        if picked:
+            self.k -= 1
+        return picked
+
+def shares(total, counts):
+    " total split in proportion to counts, adding up exactly "
+    whole = sum(counts) or 1
+    found = [total * c // whole for c in counts]
+    if found:
+        found[-1] += total - sum(found)
+    return found
+
+###-------------------------------------
+### Map writer
+
+class Map_generator(object):
+    """ Holds the options, and writes each section of the map to outf """
+    def __init__(self, options):
+        self.opts = options
+        self.seed = options.seed
+        self.objects = max(1, options.objects)
+        self.archives = min(options.archives, self.objects - 1)
+        self.symbols = max(1, options.symbols)
+        # Regions: (name, kind, prefix, block) and the symbols in each
+        self.regions = [(".isr_vector", "text", ".isr_vector", "FLASH"),
+                        (".text", "text", ".text.", "FLASH")]
+        self.regions.extend((".text%d" % i, "text", ".text.", "FLASH") for i in range(options.regions))
+        self.regions.extend([(".data", "data", ".data.", "RAM"), (".bss", "bss", ".bss.", "RAM")])
+        weights = [1, 60] + [10] * options.regions + [5, 15]
+        self.counts = shares(self.symbols - 1, weights[1:])
+        self.counts.insert(0, 1)
+        self.fills = shares(options.fills, self.counts)
+        self.splits = shares(options.splits, self.counts)
+        self.load = None # load address of .data in FLASH
+        # room for the largest text and data, padding included
+        text = sum(c for c, r in zip(self.counts, self.regions) if r[1] != "bss")
+        need = text * (TEXT_SIZE + 4)
+        self.flash_size = 0x100000
+        while self.flash_size < need:
+            self.flash_size *= 2
+        self.ram = max(RAM, FLASH + self.flash_size)
+    def rng(self, *part):
+        " a Random for one part of the map, the same for each pass "
+        return random.Random("%d-%s" % (self.seed, "-".join(str(p) for p in part)))
+    def object_of(self, symbol):
+        " objects hold consecutive symbols, as ld lists them "
+        return object_name(symbol * self.objects // self.symbols, self.objects, self.archives)
+
+    def write(self, outf):
+        self.write_preamble(outf)
+        self.write_common(outf)
+        self.write_discarded(outf)
+        self.write_memory(outf)
+        self.write_linker(outf)
+        self.write_output(outf)
+        self.write_cross_refs(outf)
+
+    def write_preamble(self, outf):
+        if not self.archives:
+            return
+        rng = self.rng("archives")
+        outf.write("Archive member included because of file (symbol)\n\n")
+        first = self.objects - self.archives
+        for member in range(first, self.objects):
+            # pulled in by an object, or by an earlier member
+            by = rng.randrange(member) if member > first and rng.random() < 0.4 else rng.randrange(first)
+            outf.write("%s\n%30s%s (%s)\n" % (object_name(member, self.objects, self.archives), "",
+                                            object_name(by, self.objects, self.archives),
+                                            function_name(member, False)))
+        outf.write("\n")
+
+    def common_symbols(self):
+        " (name, size, file) of each common symbol "
+        rng = self.rng("common")
+        for i in range(self.opts.common):
+            name = "common_%x" % i if i % 7 else "a_rather_long_common_symbol_name_%x" % i
+            yield name, rng.choice((1, 2, 4, 8, 0x20, 0x40, 0x224, 0x3b4)), \
+                  object_name(rng.randrange(self.objects), self.objects, self.archives)
+
+    def write_common(self, outf):
+        if not self.opts.common:
+            return
+        outf.write("%s\nCommon symbol       size              file\n\n" % maps.SECTIONS[1])
+        for name, size, sfile in self.common_symbols():
+            if len(name) >= 20:
+                outf.write("%s\n%20s%-18s%s\n" % (name, "", "0x%x" % size, sfile))
+            else:
+                outf.write("%-20s%-18s%s\n" % (name, "0x%x" % size, sfile))
+        outf.write("\n")
+
+    def write_discarded(self, outf):
+        rng = self.rng("discarded")
+        outf.write("%s\n\n" % maps.SECTIONS[2])
+        for i in range(self.opts.discarded):
+            prefix = rng.choice((".text.", ".rodata.", ".data.", ".bss."))
+            name = prefix + function_name(i, rng.random() < 0.3)
+            sfile = object_name(rng.randrange(self.objects), self.objects, self.archives)
+            write_record(outf, name, 0, rng.randrange(0, 0x200, 2), sfile)
+        outf.write("\n")
+
+    def write_memory(self, outf):
+        outf.write("%s\n\nName             Origin             Length             Attributes\n" % maps.SECTIONS[3])
+        outf.write("FLASH            0x%08x         0x%08x         xr\n" % (FLASH, self.flash_size))
+        outf.write("RAM              0x%08x         0x%08x         xrw\n" % (self.ram, 0x08000000))
+        outf.write("*default*        0x00000000         0xffffffff\n\n")
+
+    def write_linker(self, outf):
+        outf.write("%s\n\n" % maps.SECTIONS[4])
+        outf.write("%16s0x%08x%16s_minimum_stack_size = 0x%x\n" % ("", STACK, "", STACK))
+        outf.write("%16s0x%08x%16s_minimum_heap_size = 0x%x\n\n" % ("", HEAP, "", HEAP))
+        addr = {"FLASH": FLASH, "RAM": self.ram}
+        first = 0
+        for k, (name, kind, prefix, block) in enumerate(self.regions):
+            last = first + self.counts[k]
+            if kind == "data":
+                self.load = addr["FLASH"]
+            # a first pass to find the size for the Region's header line
+            size = self.region_body(None, k, kind, prefix, first, last, addr[block])
+            head = "%-15s 0x%08x %10s" % (name, addr[block], "0x%x" % size)
+            if kind in ("data", "bss"):
+                head += " load address 0x%08x" % self.load
+            outf.write(head + "\n")
+            outf.write("%16s0x%08x%16s. = ALIGN (0x4)\n" % ("", addr[block], ""))
+            outf.write(" *(%s*)\n" % prefix.rstrip("."))
+            self.region_body(outf, k, kind, prefix, first, last, addr[block])
+            outf.write("\n")
+            addr[block] += size
+            if kind == "data":
+                addr["FLASH"] += size # loaded from FLASH
+            first = last
+        for name, reserve, symbol in ((".heap", HEAP, "_minimum_heap_size"), (".stack", STACK, "_minimum_stack_size")):
+            outf.write("%-15s 0x%08x %10s load address 0x%08x\n" % (name, addr["RAM"], "0x%x" % reserve, self.load))
+            outf.write("%16s0x%08x%16s. = ALIGN (0x4)\n" % ("", addr["RAM"], ""))
+            outf.write("%16s0x%08x%16s. = (. + %s)\n" % ("", addr["RAM"] + reserve, "", symbol))
+            outf.write(" *fill*         0x%08x %10s \n\n" % (addr["RAM"], "0x%x" % reserve))
+            addr["RAM"] += reserve
+        for i in range(self.objects - self.archives):
+            outf.write("LOAD %s\n" % object_name(i, self.objects, self.archives))
+        for lib in sorted(set(object_name(i, self.objects, self.archives).split("(")[0]
+                              for i in range(self.objects - self.archives, self.objects))):
+            outf.write("LOAD %s\n" % lib)
+
+    def region_body(self, outf, k, kind, prefix, first, last, addr):
+        """ the input sections of Region k, symbols first to last
+            - outf None only adds up the size
+            Return size
+        """
+        rng = self.rng("region", k)
+        fill = Chooser(self.fills[k], last - first, rng)
+        split = Chooser(self.splits[k], last - first, rng)
+        start = addr
+        for i in range(first, last):
+            long_name = split()
+            name = function_name(i, long_name)
+            if kind == "text" and rng.random() < 0.2 and (long_name or fits(".rodata.", name)):
+                section = ".rodata." + name
+            else:
+                section = prefix + (name if prefix[-1] == "." else "")
+            size = rng.randrange(2, TEXT_SIZE, 2) if kind == "text" else rng.choice((1, 2, 4, 8, 0xc, 0x14, 0x100))
+            padding = fill()
+            if outf is not None:
+                write_record(outf, section, addr, size, self.object_of(i))
+                if kind != "bss" or i % 3:
+                    outf.write("%16s0x%08x%16s%s\n" % ("", addr, "", name))
+            addr += size
+            if padding:
+                pad = rng.randrange(1, 4)
+                if outf is not None:
+                    outf.write(" *fill*         0x%08x %10s \n" % (addr, "0x%x" % pad))
+                addr += pad
+        if kind == "bss" and self.opts.common:
+            # COMMON of each file holding common symbols, with their labels
+            files = {}
+            for name, size, sfile in self.common_symbols():
+                files.setdefault(sfile, []).append((name, size))
+            for sfile in sorted(files):
+                size = sum(s for n, s in files[sfile])
+                if outf is not None:
+                    write_record(outf, "COMMON", addr, size, sfile)
+                    at = addr
+                    for name, s in files[sfile]:
+                        outf.write("%16s0x%08x%16s%s\n" % ("", at, "", name))
+                        at += s
+                addr += size
+        return addr - start
+
+    def write_output(self, outf):
+        outf.write("OUTPUT(build/firmware.elf elf32-littlearm)\n\n")
+        for name, size in ((".ARM.attributes", 0x37), (".comment", 0x70)):
+            outf.write("%-15s 0x%08x %10s\n" % (name, 0, "0x%x" % size))
+            write_record(outf, name, 0, size, object_name(0, self.objects, self.archives))
+            outf.write("\n")
+
+    def write_cross_refs(self, outf):
+        if not self.opts.xrefs:
+            return
+        rng = self.rng("xrefs")
+        outf.write("%s\n\n%-50s%s\n" % (maps.SECTIONS[6], "Symbol", "File"))
+        step = max(1, self.symbols // self.opts.xrefs)
+        for j in range(self.opts.xrefs):
+            i = (j * step) % self.symbols
+            name = function_name(i, False) + ("" if j < self.symbols else "_%x" % j)
+            outf.write("%-50s%s\n" % (name, self.object_of(i)))
+            for r in range(rng.randrange(4)):
+                outf.write("%50s%s\n" % ("", object_name(rng.randrange(self.objects), self.objects, self.archives)))
+
+def write_record(outf, name, addr, size, sfile):
+    " an input section line, split after a long name "
+    if len(name) > NAME_WIDTH:
+        outf.write(" %s\n%16s0x%08x %10s %s\n" % (name, "", addr, "0x%x" % size, sfile))
+    else:
+        outf.write(" %-14s 0x%08x %10s %s\n" % (name, addr, "0x%x" % size, sfile))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic GNU ld map file")
+    parser.add_argument("-o", "--output", default=None, help="map file to write (default stdout)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default 1)")
+    parser.add_argument("--objects", type=int, default=200, help="object files (default 200)")
+    parser.add_argument("--archives", type=int, default=20,
+                        help="of the objects, how many are archive members (default 20)")
+    parser.add_argument("--symbols", type=int, default=5000, help="input sections (default 5000)")
+    parser.add_argument("--regions", type=int, default=0, help="extra text Regions (default 0)")
+    parser.add_argument("--fills", type=int, default=200, help="*fill* records (default 200)")
+    parser.add_argument("--splits", type=int, default=1500,
+                        help="input sections with long names, split over two lines (default 1500)")
+    parser.add_argument("--common", type=int, default=10, help="COMMON symbols (default 10)")
+    parser.add_argument("--discarded", type=int, default=1000, help="discarded input sections (default 1000)")
+    parser.add_argument("--xrefs", type=int, default=2000, help="cross referenced symbols (default 2000)")
+    args = parser.parse_args(argv)
+    #
+    args.splits = min(args.splits, args.symbols)
+    args.fills = min(args.fills, args.symbols)
+    generator = Map_generator(args)
+    if args.output:
+        with open(args.output, 'w', 1 << 20) as outf:
+            generator.write(outf)
+    else:
+        generator.write(sys.stdout)
+
+
+###
+if __name__ == "__main__":
+    main()
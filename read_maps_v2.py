@@ -25,14 +25,37 @@
 ### As usual Unix is different.
 
 
-import sys
+import argparse
+import cPickle
+import cProfile
+import fnmatch
+import gc
+import glob
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import posixpath
+import re
+import sqlite3
+import time
+from array import array
+from bisect import bisect_right
+from heapq import heapify, heappop, heappush
+from itertools import chain, groupby
+from operator import itemgetter, methodcaller
+try:
+    import numpy # optional, for the .npz export
+except ImportError:
+    numpy = None
 DEBUG = False # verbose printing switch
 
 ### map file sections (by examination)
 # These are the sections in the .map file
-SECTIONS = ["Preamble", # not a label. gather initial text
+SECTIONS = ["Preamble", # not a label. Archive members included, and why
             "Allocating common symbols",    # Symbols, their size, file ref
-            "Discarded input sections",     # ignoring for now
+            "Discarded input sections",     # removed by --gc-sections
             "Memory Configuration",         # Blocks like RAM and Flash
             "Linker script and memory map", # mem map defined in here
                # mem map is .text, .rodata, .bss,  COMMON, .heap, .stack. .ARM
@@ -41,6 +64,43 @@ SECTIONS = ["Preamble", # not a label. gather initial text
             "Cross Reference Table"         # unix_only?
             ]
 
+### Symbol lines in the linker memory map
+# Input sections (and *fill*) with addr, size, file (or fill value).
+#  - a long name puts addr, size, file on the next line
+#  - then any label and attribute lines inside the symbol
+SYMBOL_LINE = re.compile(r"""
+    \n[ ]([.C*]\S*)                 # input section, COMMON or *fill*
+    \s+(0x\w+)                     # addr - maybe on next line
+    [ ]+(0x\w+)                     # size
+    ([^\n]*(?:\n[ ][ ]+0x[^\n]*)*)   # file, then label and attribute lines
+    """, re.X)
+HEX_WORD = re.compile(r"\b0[xX][0-9a-fA-F]+") # addresses in a text dump
+INDENTED = methodcaller("startswith", " ") # body lines of a region
+NO_LINE = ("",)
+# Classes of input section, as the size tool counts them (rodata is text)
+SECTION_CLASSES = ["text", "data", "bss"]
+# Input sections not loaded into the target memory
+NOT_LOADED = (".debug", ".comment", ".ARM.attributes", ".stab", ".note.gnu.gold")
+# Regions classed as bss or data by name, the rest by their Block
+BSS_REGIONS = (".bss", ".sbss", ".tbss", ".noinit")
+DATA_REGIONS = (".data", ".sdata", ".tdata", ".init_array", ".fini_array", ".preinit_array",
+                ".jcr", ".dynamic", ".got", ".tm_clone_table")
+# Regions reserving RAM for the heap and stack, not holding anything
+RESERVED_REGIONS = (".heap", ".stack", "._user_heap_stack")
+# Linker script statements listed with the labels of an input section
+SCRIPT_STATEMENTS = ("PROVIDE", "PROVIDE_HIDDEN", "ASSERT")
+
+### short names for SECTIONS, used to choose which are parsed
+SECTION_NAMES = {"preamble": SECTIONS[0],
+                 "common":   SECTIONS[1],
+                 "discarded":SECTIONS[2],
+                 "blocks":   SECTIONS[3],
+                 "linker":   SECTIONS[4],
+                 "output":   SECTIONS[5],
+                 "xref":     SECTIONS[6]
+                 }
+PARSED = ["preamble", "common", "discarded", "blocks", "linker", "output", "xref"] # parsed by default
+
 ### export groups - ! limited for initial D3 version
 CATS = ['.text', '.data',  '.rodata', '.heap','.stack', '.bss']
 #CATS = ['.data',  '.rodata', '.heap','.stack', '.bss'] # text is BIG
@@ -55,6 +115,10 @@ class Memory_map(object):
         self.system = sysname
         self.blocks = blocks
         self.output_loc = ""
+        self.discarded = None # Discard_stats
+        self.cross_refs = None # Cross_refs
+        self.common_symbols = None # Common_symbols
+        self.archives = None # Archive_graph
     def __repr__(self):
         return "<Memmap %s %d blocks>" %(self.system, len(self.blocks))
     def describe(self):
@@ -62,26 +126,108 @@ class Memory_map(object):
         print " Output in", self.output_loc
         for b in self.blocks:
             b.describe(" ")
-    
+
+    @property
+    def blocks(self):
+        return self._blocks
+    @blocks.setter
+    def blocks(self, blocks):
+        self._blocks = blocks
+        self.index = None # rebuilt on next lookup
+    def find_block(self, addr):
+        """ the most specific Block holding addr (int or hex string)
+            - None if not in any Block
+        """
+        if self.index is None:
+            self.index = Block_index(self.blocks)
+        if not isinstance(addr, (int, long)):
+            addr = int(addr, 16)
+        return self.index.find(addr)
+    def find_blocks(self, addrs):
+        """ find_block for many addresses (ints or hex strings)
+            Return list of Blocks (or None)
+        """
+        if self.index is None:
+            self.index = Block_index(self.blocks)
+        find = self.index.find
+        return [find(a if isinstance(a, (int, long)) else int(a, 16)) for a in addrs]
+
     def add_region(self, region):
         """ put region into proper Block based on addr, dur """
         addr = region.addr
-        if addr:
-            fail = True
-            for b in self.blocks:
-                if int(b.addr,16) <= int(addr,16) <= int(b.addr,16)+int(b.dur,16):
-                    b.add_region(region)
-                    fail = False
-                    break # possibly *default* section which will get duplicates unless we break.
-            if fail:
+        if addr is not None:
+            block = self.find_block(addr)
+            if block:
+                block.add_region(region)
+            else:
                 print "!! failed to find Block for Region %s" % (region)
+    def object_sizes(self):
+        """ bytes each input file puts into the loaded Regions
+            - *fill*, debug sections, heap and stack reservations
+              and merged sections listed at 0x0 are not counted
+            Return dict of file: bytes
+        """
+        sizes = {}
+        for block in self.blocks:
+            for region in block.regions:
+                if not is_loaded(region) or is_reserved(region):
+                    continue
+                for name, addr, size, sfile in iter_placed_sections(region):
+                    if sfile is not None and name != "*fill*":
+                        sizes[sfile] = sizes.get(sfile, 0) + size
+        return sizes
+    def object_breakdown(self):
+        """ Object_breakdown of the loaded Regions, in one pass
+            - classed by Region, see region_class
+            - counts the same input sections as object_sizes
+        """
+        breakdown = Object_breakdown(self.system)
+        add = breakdown.add
+        for block in self.blocks:
+            for region in block.regions:
+                if not is_loaded(region) or is_reserved(region):
+                    continue
+                section_class = region_class(block, region)
+                for name, addr, size, sfile in iter_placed_sections(region):
+                    if sfile is not None and size and name != "*fill*":
+                        add(sfile, section_class, size)
+        return breakdown
+    def fill_stats(self):
+        """ Fill_stats of the *fill* in the loaded Regions
+            - each fill is charged to the object file before it
+            - a Region holding only fill is space reserved with . = . + size
+              (e.g. .heap, .stack), not padding
+        """
+        stats = Fill_stats(self.system)
+        for block in self.blocks:
+            for region in block.regions:
+                if not is_loaded(region):
+                    continue
+                name = region.fullname()
+                fills = []
+                before = None
+                for sname, addr, size, sfile in iter_input_sections(region):
+                    if sname == "*fill*":
+                        fills.append((before, size))
+                    elif size:
+                        before = sfile
+                if before is None: # nothing but fill
+                    reserved = sum(size for b, size in fills)
+                    if reserved:
+                        stats.reserved[name] = reserved
+                    continue
+                for before, size in fills:
+                    stats.add(block.name, name, before, size)
+        return stats
     def collect_region_names(self, region_names = []): 
-        """ insert a block of reiogn names into eth growing list
+        """ merge the region names of each Block into region_names
             - use the existing list as the primary order
+            Return new list
         """
-        for b in self.blocks:
-            ordered_insert(region_names, b.collect_region_names())
-        return region_names
+        return merge_orders([region_names] + self.region_orders())
+    def region_orders(self):
+        " list of region names in each Block, for merge_orders "
+        return [b.collect_region_names() for b in self.blocks]
 
 class Block(object):
     """ Representing a range of memory addresses.
@@ -89,15 +235,23 @@ class Block(object):
         - an address, duration, name, attributes
         - holds the Regions referenced in that block of addresses
     """
-    def __init__(self, addr, dur, name, attr):
-        # all stored strings
-        self.addr = addr 
+    __slots__ = ("addr", "dur", "width", "name", "attr", "regions")
+    def __init__(self, addr, dur, name, attr, width=8):
+        # addr, dur are ints. width is hex digits in the map file
+        self.addr = addr
         self.dur = dur
+        self.width = width
         self.name = name
         self.attr = attr
         self.regions = []  # hold regions that belong in address space of this block
     def __repr__(self):
-        return "<Block %s %s (dur %s) %s %dregions>" % (self.addr, self.name, self.dur, self.attr, len(self.regions))
+        return "<Block %s %s (dur %s) %s %dregions>" % (self.addr_text, self.name, self.dur_text, self.attr, len(self.regions))
+    @property
+    def addr_text(self):
+        return hex_text(self.addr, self.width)
+    @property
+    def dur_text(self):
+        return hex_text(self.dur, self.width)
     def describe(self, preamble=""):
         print preamble,self
         for r in self.regions:
@@ -105,10 +259,10 @@ class Block(object):
 
     def address(self):
         " return as num, byte_count"
-        return (int(self.addr, 0), (len(self.addr)-2)//2)
+        return (self.addr, self.width//2)
     def duration(self):
         " return as num, byte_count"
-        return (int(self.dur, 0), (len(self.dur)-2)//2)
+        return (self.dur, self.width//2)
     def add_region(self, region):
         #print "Adding region", region
         self.regions.append(region)
@@ -118,16 +272,56 @@ class Block(object):
         return  [r.fullname() for r in self.regions]
 
 
+class Block_index(object):
+    """ Sorted table of address ranges for bisect lookup of Blocks.
+        - Blocks may nest (e.g. *default* holds all the others)
+          so each range maps to the smallest Block containing it.
+        - a lookup is O(log n) however the Blocks overlap
+    """
+    def __init__(self, blocks):
+        spans = [] # start, end, Block
+        for b in blocks:
+            spans.append((b.addr, b.addr + b.dur, b))
+        bounds = sorted(set([s[0] for s in spans] + [s[1] for s in spans]))
+        self.starts = [] # start addr of each range
+        self.blocks = [] # Block for each range, None if a gap
+        for lo, hi in zip(bounds, bounds[1:]):
+            best = None
+            for start, end, b in spans:
+                # smallest wins, first listed on a tie
+                if start <= lo and hi <= end and (best is None or end-start < best[1]-best[0]):
+                    best = (start, end, b)
+            block = best[2] if best else None
+            if self.blocks and self.blocks[-1] is block:
+                continue # same as range before
+            self.starts.append(lo)
+            self.blocks.append(block)
+        if bounds:
+            self.starts.append(bounds[-1]) # past the end
+            self.blocks.append(None)
+    def __repr__(self):
+        return "<Block_index %d ranges>" % len(self.starts)
+    def find(self, addr):
+        " return Block holding int addr, or None "
+        i = bisect_right(self.starts, addr) - 1
+        if i < 0:
+            return None
+        return self.blocks[i]
+
+
 class Region(object):
     """ Regions contain a series of generally adjacent Symbols
         which belong in the same domain.
         - E.g. the Heap, or rodata.
     """
-    def __init__(self, domain, name, addr, size):
+    __slots__ = ("domain", "name", "addr", "size", "width", "load_addr",
+                 "align", "fill", "fill_with", "attr", "records", "_symbols")
+    def __init__(self, domain, name, addr, size, width=8):
         self.domain = domain
         self.name = name
-        self.addr = addr
+        self.addr = addr # ints, or None
         self.size = size
+        self.width = width # hex digits of addresses in the map file
         #
         self.load_addr = None
         self.align = None
@@ -135,22 +329,47 @@ class Region(object):
         self.fill_with = None
         self.attr = []
         #
-        self.symbols = [] # list of Symbols in increasing (mostly) addr order
+        self.records = [] # symbol lines found by process_region
+        self._symbols = None
     def __repr__(self):
-        return "Region: %s[%s] addr=%s size=%s %d symbols" %(self.domain, self.name, self.addr, self.size, len(self.symbols))
+        return "Region: %s[%s] addr=%s size=%s %d symbols" %(self.domain, self.name, self.addr_text, self.size_text, self.symbol_count())
     def fullname(self):
         return self.domain + (self.name if self.name else "")
+    @property
+    def addr_text(self):
+        return hex_text(self.addr, self.width)
+    @property
+    def size_text(self):
+        return hex_text(self.size)
+    @property
+    def symbols(self):
+        """ list of Symbols in increasing (mostly) addr order
+            - made from the records on first use
+        """
+        if self._symbols is None:
+            self._symbols = [process_symbol(r) for r in self.records]
+            self.records = []
+        return self._symbols
+    @symbols.setter
+    def symbols(self, symbols):
+        self._symbols = symbols
+        self.records = []
+    def symbol_count(self):
+        " without making the Symbols "
+        if self._symbols is None:
+            return len(self.records)
+        return len(self._symbols)
     def describe(self, preamble=""):
         name = "Region: %s" % self.domain
         indent = "               " + preamble
         if self.name: name += self.name
-        msg = preamble + name + " addr=%s size=%s" % (self.addr, self.size)
-        if self.load_addr: msg+= " load_addr=%s" %(self.load_addr)
-        msg += " %d symbols" % len(self.symbols)
-        if self.fill or self.attr:
+        msg = preamble + name + " addr=%s size=%s" % (self.addr_text, self.size_text)
+        if self.load_addr is not None: msg+= " load_addr=%s" % hex_text(self.load_addr, self.width)
+        msg += " %d symbols" % self.symbol_count()
+        if self.align or self.fill or self.attr:
             msg+= "\n"
         if self.align: msg += indent +" align=%s" % self.align
-        if self.fill:  msg += indent +" fill=%s" % self.fill
+        if self.fill:  msg += indent +" fill=%s" % hex_text(self.fill)
         if self.attr:
             for a in self.attr:
                 msg += indent + " attr=%s\n" % a
@@ -175,9 +394,12 @@ class Linker_Load(object):
         return "<LOAD %s>" % (self.filename)
 
 class Common_symbols(object):
-    """ Hold all Common Symbols """
+    """ Hold all Common Symbols
+        - by_name finds one without a search
+    """
     def __init__(self, symbols=[]):
         self.symbols = symbols
+        self.by_name = dict((cs.name, cs) for cs in symbols)
     def __repr__(self):
         return "<Common_Symbols found %d>" %(len(self.symbols))
     
@@ -186,33 +408,392 @@ class Common_symbols(object):
             print cs
     def add(self, symbol):
         self.symbols.append(symbol)
+        self.by_name[symbol.name] = symbol
+    def find(self, name):
+        " the Common_symbol called name, or None "
+        return self.by_name.get(name)
     
 class Common_symbol(object):
     """ Some symbols have a domain=COMMON and this is a special type
         - store a symbol, size, originating file
     """
+    __slots__ = ("name", "size", "filename", "references", "addr", "block", "region")
     def __init__(self, name, size, filename):
         self.name = name
-        self.size = size
+        self.size = size # int
         self.filename = filename
-        self.references = [] # filled in by linker sction when finding COMMON labels
+        self.references = [] # files referencing it, from the Cross Reference Table
+        # placement found by link_common_symbols in the COMMON labels
+        self.addr = None # int
+        self.block = None
+        self.region = None
+    def __repr__(self):
+        msg = "<Common_symbol %s size=%s from %s" %(self.name, hex_text(self.size), self.filename)
+        if self.region is not None:
+            msg += " at %s in %s %s" % (hex_text(self.addr, self.region.width), self.block.name, self.region.fullname())
+        return msg + ">"
+
+
+class Cross_refs(object):
+    """ Two way index of the Cross Reference Table
+        - the first file listed for a symbol defines it
+          the rest reference it
+        - symbol and file names are interned, so each is stored once
+    """
+    def __init__(self):
+        self.files = {} # symbol: [defining file, referencing files...]
+        self.refs = {}  # file: [symbols it references]
+        self.defs = {}  # file: [symbols it defines]
+    def __repr__(self):
+        return "<Cross_refs %d symbols %d files>" % (len(self.files), len(self.file_names()))
+    def __len__(self):
+        return len(self.files)
+    def __contains__(self, symbol):
+        return symbol in self.files
+    def add(self, symbol, files):
+        " symbol defined in files[0] and referenced from the rest "
+        symbol = intern(symbol)
+        files = [intern(f) for f in files]
+        self.files[symbol] = files
+        if files:
+            self.defs.setdefault(files[0], []).append(symbol)
+        for f in files[1:]:
+            self.refs.setdefault(f, []).append(symbol)
+    def defined_in(self, symbol):
+        " file defining symbol, or None "
+        files = self.files.get(symbol)
+        return files[0] if files else None
+    def referenced_by(self, symbol):
+        " files referencing symbol "
+        return self.files.get(symbol, NO_LINE)[1:]
+    def references(self, filename):
+        " symbols referenced from filename "
+        return self.refs.get(filename, [])
+    def defines(self, filename):
+        " symbols defined in filename "
+        return self.defs.get(filename, [])
+    def file_names(self):
+        return set(self.refs).union(self.defs)
+    def describe(self, preamble=""):
+        print preamble + "Cross refs: %d symbols in %d files" % (len(self.files), len(self.file_names()))
+        names = sorted(self.files)
+        for name in names[:3] + (["..."] if len(names) > 6 else []) + names[max(3, len(names)-3):]:
+            if name == "...":
+                print preamble + "  ..."
+            else:
+                print preamble + "  %s: %s" % (name, " ".join(self.files[name]))
+
+
+class Archive_graph(object):
+    """ Why each archive member was linked, from the Preamble
+        - each member was pulled in by one file, for one symbol
+        - so the members form a tree under the files on the link line
+        - the map only records the first reason for each member
+    """
+    def __init__(self):
+        self.included_by = {} # member: (file, symbol)
+        self.includes = {}    # file: [members it pulled in]
+        self.as_needed = {}   # shared library: (file, symbol)
+    def __repr__(self):
+        return "<Archive_graph %d members from %d files>" % (len(self.included_by), len(self.includes))
+    def __len__(self):
+        return len(self.included_by)
+    def __contains__(self, member):
+        return member in self.included_by
+    def add(self, member, sfile, symbol):
+        " member was included for symbol, referenced by sfile "
+        member = intern(member)
+        sfile = intern(sfile)
+        self.included_by[member] = (sfile, symbol)
+        self.includes.setdefault(sfile, []).append(member)
+    def why(self, member):
+        """ chain of (member, file, symbol) back to a file on the link line
+            - empty if member was not included from an archive
+        """
+        chain = []
+        seen = set()
+        while member in self.included_by and member not in seen:
+            seen.add(member)
+            sfile, symbol = self.included_by[member]
+            chain.append((member, sfile, symbol))
+            member = sfile
+        return chain
+    def pulled_in(self, member):
+        " every member included because of member, directly or not "
+        found = []
+        seen = set([member])
+        stack = [member]
+        while stack:
+            for m in self.includes.get(stack.pop(), ()):
+                if m not in seen:
+                    seen.add(m)
+                    found.append(m)
+                    stack.append(m)
+        return found
+    def removal_size(self, member, sizes):
+        """ bytes saved by dropping the reference that included member
+            - member and all it pulled in, using sizes from Memory_map.object_sizes
+            - an upper bound, other references may keep some of them
+        """
+        return sizes.get(member, 0) + sum(sizes.get(m, 0) for m in self.pulled_in(member))
+    def roots(self):
+        " files on the link line which pulled in members "
+        return [f for f in self.includes if f not in self.included_by]
+    def top_members(self, sizes, count=None):
+        " [(member, removal_size)] largest first "
+        ranked = sorted(((m, self.removal_size(m, sizes)) for m in self.included_by),
+                        key=lambda i: (-i[1], i[0]))
+        return ranked[:count]
+    def describe(self, sizes, count=10, preamble=""):
+        print preamble + "Archive members: %d, from %d files on the link line" % (len(self.included_by), len(self.roots()))
+        for member, size in self.top_members(sizes, count):
+            print preamble + "  %8d  %s" % (size, member)
+            for m, sfile, symbol in self.why(member):
+                print preamble + "              because of %s (%s)" % (sfile, symbol)
+
+
+class Object_breakdown(object):
+    """ text, data and bss bytes of each object file (SECTION_CLASSES)
+        - from every loaded input section, see Memory_map.object_breakdown
+    """
+    def __init__(self, system=""):
+        self.system = system
+        self.by_file = {} # file: [text, data, bss]
+        self.totals = [0, 0, 0]
     def __repr__(self):
-        return "<Common_symbol %s size=%s from %s>" %(self.name, self.size, self.filename)
+        return "<Object_breakdown %s %d files text=%d data=%d bss=%d>" % ((self.system, len(self.by_file)) + tuple(self.totals))
+    def add(self, sfile, section_class, size):
+        " size bytes of section_class (index in SECTION_CLASSES) from sfile "
+        sizes = self.by_file.get(sfile)
+        if sizes is None:
+            sizes = self.by_file[sfile] = [0, 0, 0]
+        sizes[section_class] += size
+        self.totals[section_class] += size
+    def top(self, count=None, by=None):
+        """ [(file, text, data, bss, total)] largest first
+            - by a SECTION_CLASSES name, else by total
+        """
+        column = SECTION_CLASSES.index(by) + 1 if by else 4
+        rows = [(f,) + tuple(sizes) + (sum(sizes),) for f, sizes in self.by_file.iteritems()]
+        rows.sort(key=lambda r: (-r[column], r[0]))
+        return rows[:count]
+    def describe(self, count=20, by=None, preamble=""):
+        total = sum(self.totals)
+        percent = lambda size: 100.0 * size / (total or 1)
+        print preamble + "Objects in %s: %d files, %d bytes" % (self.system, len(self.by_file), total)
+        print preamble + "  %8s %8s %8s %8s %6s  %s" % ("text", "data", "bss", "total", "%", "file")
+        rows = self.top(None, by)
+        for row in rows[:count]:
+            print preamble + "  %8d %8d %8d %8d %5.1f%%  %s" % (row[1:] + (percent(row[4]), row[0]))
+        rest = rows[count:] if count is not None else []
+        if rest:
+            others = [sum(r[i] for r in rest) for i in (1, 2, 3, 4)]
+            print preamble + "  %8d %8d %8d %8d %5.1f%%  (%d others)" % (tuple(others) + (percent(others[3]), len(rest)))
+        print preamble + "  %8d %8d %8d %8d %5.1f%%  total" % (tuple(self.totals) + (total, 100.0 if total else 0.0))
+
+
+class Path_node(object):
+    """ A directory, file, archive or archive member in a Path_trie
+        - sizes are [text, data, bss] of everything below, and itself
+    """
+    __slots__ = ("name", "children", "sizes")
+    def __init__(self, name):
+        self.name = name
+        self.children = {} # name: Path_node
+        self.sizes = [0, 0, 0]
+    def __repr__(self):
+        return "<Path_node %s %d children text=%d data=%d bss=%d>" % ((self.name, len(self.children)) + tuple(self.sizes))
+    def total(self):
+        return sum(self.sizes)
+
+class Path_trie(object):
+    """ Object file sizes rolled up by their paths
+        - archive members are children of their archive,
+          e.g. mbed-classic.a(Ticker.cpp.o) is mbed-classic.a/Ticker.cpp.o
+        - paths are normalised, so py/../extmod/x.o is under extmod
+        - every node holds the totals below it, added up once when built
+    """
+    def __init__(self, breakdown):
+        self.system = breakdown.system
+        self.root = Path_node("")
+        leaves = []
+        for sfile, sizes in breakdown.by_file.iteritems():
+            node = self.root
+            for part in self.split(sfile):
+                child = node.children.get(part)
+                if child is None:
+                    child = node.children[part] = Path_node(part)
+                node = child
+            leaves.append((node, sizes))
+        for node, sizes in leaves:
+            node.sizes = [a + b for a, b in zip(node.sizes, sizes)]
+        self.add_up(self.root)
+    def __repr__(self):
+        return "<Path_trie %s %s>" % (self.system, self.root)
+    @staticmethod
+    def split(sfile):
+        " path parts of sfile, the archive member last "
+        member = None
+        if sfile.endswith(")") and "(" in sfile:
+            i = sfile.index("(")
+            sfile, member = sfile[:i], sfile[i+1:-1]
+        parts = posixpath.normpath(sfile).split("/")
+        if parts[0] == "":
+            parts[0] = "/"
+        if member:
+            parts.append(member)
+        return parts
+    def add_up(self, root):
+        " cumulative sizes, children before parents, without recursion "
+        stack = [(root, False)]
+        while stack:
+            node, done = stack.pop()
+            if not done:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children.itervalues())
+            else:
+                for child in node.children.itervalues():
+                    node.sizes = [a + b for a, b in zip(node.sizes, child.sizes)]
+    def find(self, path):
+        " the Path_node of path (a directory, archive or file), or None "
+        node = self.root
+        for part in self.split(path.rstrip("/")) if path.strip("/") else ():
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+    def describe(self, path="", depth=3, min_percent=1.0, preamble=""):
+        """ print the trie below path, depth levels down
+            - smaller nodes than min_percent of the whole are left out
+            - chains of single directories are shown as one
+        """
+        node = self.find(path)
+        if node is None:
+            print preamble + "%s not in %s" % (path, self.system)
+            return
+        total = float(self.root.total() or 1)
+        print preamble + "Paths in %s: %8s %8s %8s %6s" % (self.system, "text", "data", "bss", "%")
+        stack = [(node, path or "/", 0)]
+        while stack:
+            node, name, level = stack.pop()
+            while len(node.children) == 1 and level:
+                node = node.children.values()[0]
+                name = posixpath.join(name, node.name)
+            print preamble + "  %-40s %8d %8d %8d %5.1f%%" % ((("  " * level) + name,) + tuple(node.sizes) + (100 * node.total() / total,))
+            if level < depth:
+                children = [c for c in node.children.itervalues() if 100 * c.total() / total >= min_percent]
+                children.sort(key=lambda c: (c.total(), c.name), reverse=True)
+                stack.extend((c, c.name, level + 1) for c in reversed(children))
+
+
+class Fill_stats(object):
+    """ Alignment padding, the *fill* between input sections
+        - bytes and count per Block, per Region
+          and per object file before the fill (None at a Region start)
+    """
+    def __init__(self, system=""):
+        self.system = system
+        self.by_block = {}  # block: [bytes, count]
+        self.by_region = {} # (block, region): [bytes, count]
+        self.by_file = {}   # file before: [bytes, count]
+        self.reserved = {}  # region: bytes, of Regions that are only fill
+        self.size = 0
+        self.count = 0
+    def __repr__(self):
+        return "<Fill_stats %s %d bytes in %d fills>" % (self.system, self.size, self.count)
+    def add(self, block, region, before, size):
+        " size bytes of fill in region of block, after the file before "
+        self.size += size
+        self.count += 1
+        for totals, key in ((self.by_block, block), (self.by_region, (block, region)),
+                            (self.by_file, before)):
+            found = totals.get(key)
+            if found is None:
+                found = totals[key] = [0, 0]
+            found[0] += size
+            found[1] += 1
+    @staticmethod
+    def ranked(totals, count=None):
+        " [(key, bytes, fills)] largest first "
+        ranked = sorted(totals.iteritems(), key=lambda i: (-i[1][0], i[0]))
+        return [(k, t[0], t[1]) for k, t in ranked[:count]]
+    def describe(self, count=10, preamble=""):
+        print preamble + "Fill in %s: %d bytes in %d fills" % (self.system, self.size, self.count)
+        if self.reserved:
+            print preamble + " not counted, reserved: %s" % ", ".join("%s %d" % r for r in sorted(self.reserved.iteritems()))
+        total = float(self.size or 1)
+        for title, totals in (("Block", self.by_block), ("Region", self.by_region),
+                              ("after object file", self.by_file)):
+            print preamble + " by %s:" % title
+            for key, size, fills in self.ranked(totals, count):
+                if isinstance(key, tuple):
+                    key = " ".join(key)
+                print preamble + "  %8d %5.1f%% %5d  %s" % (size, 100*size/total, fills, key or "(region start)")
+
+
+class Discard_stats(object):
+    """ Totals of the "Discarded input sections"
+        - removed from the link by --gc-sections
+        - bytes and count per object file and per section type
+          (.text, .rodata, ...). The sections themselves are not kept
+    """
+    def __init__(self):
+        self.by_file = {} # file: [bytes, count]
+        self.by_type = {} # section type: [bytes, count]
+        self.size = 0
+        self.count = 0
+    def __repr__(self):
+        return "<Discard_stats %d bytes in %d sections from %d files>" % (self.size, self.count, len(self.by_file))
+    def add(self, name, size, sfile):
+        " count one discarded input section "
+        self.size += size
+        self.count += 1
+        totals = self.by_file.get(sfile)
+        if totals is None:
+            totals = self.by_file[sfile] = [0, 0]
+        totals[0] += size
+        totals[1] += 1
+        stype = section_type(name)
+        totals = self.by_type.get(stype)
+        if totals is None:
+            totals = self.by_type[stype] = [0, 0]
+        totals[0] += size
+        totals[1] += 1
+    def top_files(self, count=None):
+        " [(file, bytes, sections)] largest first "
+        ranked = sorted(self.by_file.iteritems(), key=lambda i: (-i[1][0], i[0]))
+        return [(f, t[0], t[1]) for f, t in ranked[:count]]
+    def top_types(self, count=None):
+        " [(section type, bytes, sections)] largest first "
+        ranked = sorted(self.by_type.iteritems(), key=lambda i: (-i[1][0], i[0]))
+        return [(n, t[0], t[1]) for n, t in ranked[:count]]
+    def describe(self, count=10, preamble=""):
+        print preamble + "Discarded by --gc-sections: %d bytes in %d input sections" % (self.size, self.count)
+        total = float(self.size or 1)
+        print preamble + " by section type:"
+        for name, size, sections in self.top_types(count):
+            print preamble + "  %8d %5.1f%% %5d  %s" % (size, 100*size/total, sections, name)
+        print preamble + " by object file:"
+        for name, size, sections in self.top_files(count):
+            print preamble + "  %8d %5.1f%% %5d  %s" % (size, 100*size/total, sections, name)
 
 
 class Symbol(object):
     """ Many symbols can appear linked to the one address.
         - store the locations and lists of symbols and their attributes
     """
+    __slots__ = ("addr", "size", "file", "fill", "fill_with", "labels",
+                 "primary", "attributes")
     def __init__(self, addr, size, primary, fill=None, fill_with=None ):
+        # addr, size, fill are ints
         self.addr = addr
         self.size = size
         self.file = None
         self.fill = fill
         self.fill_with = fill_with
-        self.labels = [] # add new ones here (unique test as added ?)
+        self.labels = () # replaced by a list of (addr, name) when there are labels
         self.primary = primary # the LHS, also need to check in labels list for matches
-        self.attributes = []
+        self.attributes = ()
         
         # each entry is:
         #  sym_domain.label, addr, size, file
@@ -223,10 +804,13 @@ class Symbol(object):
         # check label on RHS of second line and use if primary not the same (and not attr)
         # attributes are "load address", ".", PROVIDE
     def __repr__(self):
-        return "<Symbol %s %s, %s>" %(self.primary, self.addr, self.size)
-    def describe(self):
-        msg = "Symbol: %s addr=%s, size=%s, file=%s" %(self.primary, self.addr, self.size, self.file)
-        if self.fill: msg += " fill=%s with-%s" %(self.fill,self.fill_with)
+        return "<Symbol %s %s, %s>" %(self.primary, self.addr_text(), hex_text(self.size))
+    def addr_text(self, width=8):
+        " width is hex digits in the map file, see Region.width "
+        return hex_text(self.addr, width)
+    def describe(self, width=8):
+        msg = "Symbol: %s addr=%s, size=%s, file=%s" %(self.primary, self.addr_text(width), hex_text(self.size), self.file)
+        if self.fill: msg += " fill=%s with-%s" %(hex_text(self.fill),self.fill_with)
         if self.labels: msg+= " %d labels" % len(self.labels)
         if self.attributes: msg+= " %d attributes" % len(self.attributes)
         return msg
@@ -236,6 +820,15 @@ class Symbol(object):
 ###------------------------------------------
 ### Helper functions
 
+def hex_text(value, width=0):
+    """ Text of an address or size as in the map file
+        - width is the number of hex digits (zero padded)
+        - None stays None
+    """
+    if value is None:
+        return None
+    return "0x%0*x" % (width, value)
+
 def extract_system_name(name):
     """ look for handy system name in filename.
         - used to label top level memory map class
@@ -262,6 +855,136 @@ def clean_blocks(blocks):
     # turns out we need for unix... typical :)
     return blocks
 
+def section_type(name):
+    """ Group an input section name by type
+        e.g. .text.vstr_new_size is .text, .ARM.exidx.text.f is .ARM.exidx
+    """
+    parts = name[1:].split(".", 2)
+    if parts[0] in ("ARM", "gnu", "note") and len(parts) > 1:
+        return "." + parts[0] + "." + parts[1]
+    return "." + parts[0]
+
+def region_class(block, region):
+    """ index in SECTION_CLASSES of the input sections in region, in block
+        - by Region name (BSS_REGIONS, DATA_REGIONS), as input sections
+          such as .init_array can be put in .data
+        - else in a writable Block, data if it has a load address or bss
+        - the rest text
+    """
+    name = region.fullname()
+    if name.startswith(BSS_REGIONS):
+        return 2
+    if name.startswith(DATA_REGIONS):
+        return 1
+    if "w" in (block.attr or ""):
+        return 1 if region.load_addr is not None else 2
+    return 0
+
+def is_reserved(region):
+    " True for heap and stack Regions, space set aside rather than used "
+    return region.fullname().startswith(RESERVED_REGIONS)
+
+def is_loaded(region):
+    " False for debug and comment Regions, which are not in target memory "
+    return not region.fullname().startswith(NOT_LOADED)
+
+def iter_input_sections(region):
+    """ (name, addr, size, file) of each input section in region
+        - read from the records, or from the Symbols once made
+        - *fill* has its fill value as the file
+    """
+    if region.symbol_count() and region._symbols is None:
+        for name, addr, size, rest in region.records:
+            nl = rest.find("\n")
+            sfile = (rest if nl < 0 else rest[:nl]).strip() or None
+            yield name, int(addr, 16), int(size, 16), sfile
+    else:
+        for symbol in region.symbols:
+            if symbol.fill is not None:
+                yield symbol.primary, symbol.addr, symbol.size, symbol.fill_with
+            else:
+                yield symbol.primary, symbol.addr, symbol.size, symbol.file
+
+def iter_placed_sections(region):
+    """ iter_input_sections of region, less those not at their addr
+        - ld lists merged sections (.rodata.str1.1, .rodata.cst16) folded
+          into an earlier one at 0x0, with their size before merging
+        - so skip any outside the Region, or starting before the end
+          of the input section before it
+    """
+    start = region.addr
+    if start is None:
+        return
+    end = None if region.size is None else start + region.size
+    last = start # end of the last placed input section
+    for section in iter_input_sections(region):
+        addr = section[1]
+        if addr < last or end is not None and addr >= end and section[2]:
+            continue
+        last = addr + section[2]
+        yield section
+
+def iter_symbols(region):
+    """ the Symbols of region, made one at a time if not already made
+        - so a whole map can be walked without keeping its Symbols
+    """
+    if region._symbols is None:
+        return (process_symbol(r) for r in region.records)
+    return iter(region._symbols)
+
+def label_name(data):
+    """ the label of a split line inside an input section
+        - None for an attribute: PROVIDE, ASSERT, . = ALIGN, x = y,
+          (size before relaxing)
+        - C++ labels have spaces
+    """
+    if data[1].split("(")[0] in SCRIPT_STATEMENTS:
+        return None
+    if len(data) == 2:
+        return data[1]
+    if data[1][0] in "(.0" or "=" in data:
+        return None
+    return " ".join(data[1:])
+
+def iter_labels(region, primary=None):
+    """ (addr, name) of each label in the input sections of region
+        - only in input sections called primary (e.g. COMMON) if given
+        - read from the records, or from the Symbols once made
+    """
+    if region.symbol_count() and region._symbols is None:
+        for name, addr, size, rest in region.records:
+            if primary is not None and name != primary or "\n" not in rest:
+                continue
+            for line in rest.split("\n")[1:]:
+                data = line.split()
+                label = label_name(data)
+                if label is not None:
+                    yield int(data[0], 16), label
+    else:
+        for symbol in region.symbols:
+            if primary is None or symbol.primary == primary:
+                for label in symbol.labels:
+                    yield label
+
+def link_common_symbols(memmap, common_symbols):
+    """ Join the Common_symbols to the COMMON input sections of the linker map
+        - one pass over the Regions, hashed on the label names
+        - sets addr, block and region of each Common_symbol placed
+        - references come from the cross refs when parsed
+    """
+    find = common_symbols.by_name.get
+    for block in memmap.blocks:
+        for region in block.regions:
+            for addr, name in iter_labels(region, "COMMON"):
+                cs = find(name)
+                if cs is not None:
+                    cs.addr = addr
+                    cs.block = block
+                    cs.region = region
+    if memmap.cross_refs:
+        for cs in common_symbols.symbols:
+            cs.references = list(memmap.cross_refs.referenced_by(cs.name))
+
 def create_regions(memmap, region_list):
     """ given a list of regions,
         - insert into the correct Blocks (based on address)
@@ -269,35 +992,53 @@ def create_regions(memmap, region_list):
     for r in region_list:
         memmap.add_region(r)
 
-def ordered_insert(primary, newlist):
-    """ for each item in newlist try to insert into primary in same order
-    """
-    print "inserting into list"
-    print primary
-    print newlist
-    for idx in range(len(newlist)):
-        item = newlist[idx]
-        found_prioritem = found_postitem = prioritem = postitem = False
-        if item not in primary:
-            # insert it
-            # find if prior item to idx is in primary
-            if idx>0: 
-                prioritem = newlist[idx-1]
-                found_prioritem = primary.index(prioritem) if prioritem in primary else False
-            # find if post item to idx is in primary
-            if idx<len(newlist)-1: 
-                postitem = newlist[idx+1]
-                found_postitem = primary.index(postitem) if postitem in primary else False
-            # if both then insert after prior
-            # if one then insert after prior or before post
-            #print primary, item, prioritem, postitem, found_prioritem, found_postitem
-            if found_prioritem:
-                primary.insert(found_prioritem+1, item)
-            elif found_postitem:
-                primary.insert(found_postitem, item)
-            else: # append to end ?
-                primary.append(item)
-    return primary
+def merge_orders(orders):
+    """ Merge lists of names into one list, keeping the order of each
+        - each list says which names come before which
+        - a name goes as early as that allows, ties go to the
+          name seen first (so the first list is the primary order)
+        - where lists disagree the earliest seen name is taken
+        A topological sort with hashed lookups. Near linear time.
+    """
+    rank = {}   # name: first seen position
+    after = {}  # name: names which must come after it
+    waits = {}  # name: count of names which must come before it
+    edges = set()
+    for order in orders:
+        prev = None
+        for name in order:
+            if name not in rank:
+                rank[name] = len(rank)
+                after[name] = []
+                waits[name] = 0
+            if prev is not None and prev != name and (prev, name) not in edges:
+                edges.add((prev, name))
+                after[prev].append(name)
+                waits[name] += 1
+            prev = name
+    names = sorted(rank, key=rank.get)
+    ready = [rank[n] for n in names if not waits[n]] # heap of ranks
+    heapify(ready)
+    merged = []
+    done = set()
+    first = 0 # earliest name that may not be done
+    while len(merged) < len(names):
+        if ready:
+            name = names[heappop(ready)]
+            if name in done:
+                continue
+        else:
+            # orders disagree. Take earliest seen
+            while names[first] in done:
+                first += 1
+            name = names[first]
+        done.add(name)
+        merged.append(name)
+        for n in after[name]:
+            waits[n] -= 1
+            if not waits[n] and n not in done:
+                heappush(ready, rank[n])
+    return merged
     
 def print_body(body):
     " to help with parsing a region "
@@ -322,22 +1063,22 @@ def region_summary(regions):
     returned_cats = []
     maxlen = 0
     for r in regions:
-        mem_use.append([r.domain, r.addr, r.size])
+        mem_use.append([r.domain, r.addr, r.size, r.width])
         maxlen = max(maxlen, len(r.domain))
     print "Memory stats"
-    for name,start,length in mem_use:
-        start_dec = 0 if not start else int(start,0)//1024
+    for name,start,length,width in mem_use:
+        start_dec = 0 if start is None else start//1024
         length_dec = 0
-        if start:
+        if start is not None:
             #print"length=", length,start,name
             if length:
-                length_dec = int(length,0)//1024
+                length_dec = length//1024
                 if length_dec: # 0 in kb so use bytes
                     length_dec = str(length_dec)+"kB"
-                else: length_dec = str(int(length,0))+"B"
+                else: length_dec = str(length)+"B"
             else: # length = None # possibly directive
                 length = length_dec = ""
-        print "{0:{maxlen}} start={1:10} length={2:8} ({3:d}k,{4})".format(name,start,length,start_dec,length_dec, maxlen=maxlen)
+        print "{0:{maxlen}} start={1:10} length={2:8} ({3:d}k,{4})".format(name,hex_text(start, width),hex_text(length) if length != "" else "",start_dec,length_dec, maxlen=maxlen)
         if name in CATS:
             # collect to save to file
             if length:
@@ -355,116 +1096,80 @@ def process_attr(region, attr):
         - could be a load address or an alignment adjustment
     """
     if attr[0] == 'load' and attr[1] == 'address':
-        region.load_addr = attr[2]
+        region.load_addr = int(attr[2], 16)
     elif attr[0] == '.' and attr[2] == 'ALIGN':
         region.align = attr[-1]
     else:
         region.attr.append(attr)
 
-def process_symbol(region, body, idx, name):
-    """ Region is parsed. So new symbols in this region start with "."
-        - may be split over lines (see refs for examples)
+def process_labels(symbol, extra):
+    """ The lines after a Symbol holding extra locations within it
+        - a label, e.g. 0x080013b8 f_open, kept as (addr, name)
+        - or an attribute e.g. PROVIDE, . = ALIGN, see label_name
     """
-    symbols = []
-    in_symbol = True
-    print len(body), idx
-    for i in range(idx, idx+20):
-        print body[i]
-    print
-    #
-    while in_symbol:
-        line = body[idx]
-        print line
-        syn_name = line[0]
-        addr = line[1]
-        size = line[2]
-        sfile = line[3]
-        symbol = Symbol(addr, size, syn_name)
+    labels = []
+    attributes = []
+    for line in extra.split("\n")[1:]:
+        data = line.split()
+        label = label_name(data)
+        if label is None:
+            attributes.append(" ".join(data[1:]))
+        else:
+            labels.append((int(data[0], 16), label))
+    if labels: symbol.labels = labels
+    if attributes: symbol.attributes = attributes
+
+def process_symbol(record):
+    """ Create the Symbol for a record found by SYMBOL_LINE
+        - name is the input section e.g. .text.f_open or COMMON, or *fill*
+        - rest is the file (or fill value) and any label lines
+    """
+    name, addr, size, rest = record
+    addr = int(addr, 16)
+    size = int(size, 16)
+    nl = rest.find("\n")
+    if nl < 0:
+        sfile = rest.strip() or None
+    else:
+        sfile = rest[:nl].strip() or None
+    if name == "*fill*":
+        symbol = Symbol(addr, size, name, size, sfile)
+    else:
+        symbol = Symbol(addr, size, name)
         symbol.file = sfile
-        idx += 1
-        if idx > len(body):
-            in_symbol = False
-        else: # look ahead a line
-            line = body[idx]
-            if line[0][0] == ".": # starting new symbol
-                in_symbol = False
-                idx -= 1
-                print "new sym - xit", line[0]
-            else:
-                # next line is same symbol if addr same
-                if line[0] == addr:
-                    # check label same esle add to labels
-                    print " adding label", line[1:]
-                    symbol.labels.append(line[1:])
-                    idx += 1
-                else: # new symbol
-                    print "newsym", line
-        print symbol.describe()
-        
-    #
-    sys.exit()
-    return symbols, idx
+    if nl >= 0:
+        process_labels(symbol, rest[nl:])
+    return symbol
 
 
-def process_region(body, verbose=DEBUG):
-    """ Called by Parse region to extract region info
-        - also then processes Symbols in that region
+def process_region(region, body, verbose=DEBUG):
+    """ Called by parse_region to process the lines of a region
+        - attributes of the region itself come before its Symbols
+        - Symbols (input sections and *fill*) are found in one pass
+          as records. The Symbol classes are made from them on first use
     """
-    addr = size = attr = None
-    #print_body(body)
-    # Cleanup
-    # -remove "*()"
-    body = [b for b in body if b[0][:2] != "*("]
-    # -get the addr, size on same line
-    if not body[0][2] and len(body)>1:
-        body[0][2] = body[1]
-        del(body[ 1])
-##    print_body(body)
-    # name
-    domain = body[0][0]
-    name = body[0][1]
-    # extract addr, size if there
-##    if domain and domain.find('exception_ra') >-1:
-##        print "###",body[0]
-    if body[0][2]:
-        if len(body[0][2]) == 2: # only addr, size
-            addr,size = body[0][2]
-        elif len(body[0][2]) > 2: # has attributes?
-            addr = body[0][2][0]
-            if body[0][2][1][:2] == "0x":
-                size = body[0][2][1]
-                attr = body[0][2][2:]
-            else:
-                attr = body[0][2][1:]
-    region = Region(domain, name, addr, size)
-    if attr:
-        process_attr(region, attr) # add attr to region
-    # consume lines staring with addresses
-    if len(body) > 1:
-        idx = 1
-        while idx < len(body):
-            val = body[idx][0]
-            if val[:2] == '0x' and val == addr:
-                # attribute
-                process_attr(region, body[idx][1:]) # add attr to region
-                # attribute or fill
-            elif val == '*fill*' and body[idx][1] == addr:
-                # add fill
-                region.fill = body[idx][-1]
-            elif val[0] == ".":
-                # a symbol.
-##                symbol,idx = process_symbol(region, body, idx, name)
-##                region.symbols.append(symbol)
-                pass
-            # 
-            idx += 1
+    addr = region.addr
+    # region attributes
+    found = SYMBOL_LINE.search(body)
+    start = found.start() if found else len(body)
+    for line in body[:start].split("\n"):
+        data = line.split()
+        if data and data[0][:2] == "0x" and int(data[0], 16) == addr:
+            process_attr(region, data[1:]) # add attr to region
+    if not found:
+        return
+    # symbols
+    records = SYMBOL_LINE.findall(body, start)
+    for name, sym_addr, size, rest in records:
+        if int(sym_addr, 16) != addr:
+            break
+        if name == "*fill*": # fill at start of region
+            region.fill = int(size, 16)
+    region.records = records
     #
     if verbose:
         #print region
         region.describe()
-    #
-    #sys.exit()
-    return region
     
     
 def parse_sym_name(line):
@@ -487,41 +1192,66 @@ def parse_sym_name(line):
 
 
 ### Regions
-def parse_region(section, idx):
+def iter_top_level(section):
+    """ Group the lines of a section under the top level line before them
+        - yield (line, body). body is the indented lines after line
+          joined into one string, each after a newline. "" if none
+        - line is None for indented lines at the start of the section
+    """
+    line = None
+    for indented, group in groupby(section, INDENTED):
+        if indented: # each body line starts with "\n"
+            yield line, "\n".join(chain(NO_LINE, group))
+            line = None
+        else:
+            for top in group:
+                if line is not None:
+                    yield line, ""
+                line = top
+    if line is not None:
+        yield line, ""
+
+def parse_region(line, body):
     """ Called by parse_linker_memmap
-        - parses entire region
+        - parses entire region from its top level line and indented body
+        Return the Region
     """
-    done = False
-    line = section[idx]
-    sym_domain, sym_name = parse_sym_name(line)
+    addr = size = attr = None
+    domain, name = parse_sym_name(line)
     # maybe a long line or just label.
-    line = line.split()
-    if len(line) > 1:
-        rest = line[1:]
-    else:
-        rest = None
-    body = [[sym_domain, sym_name, rest]]
-    # rest of lines
-    idx += 1
-    while not done:
-        if idx >= len(section):
-            done = True
-        else:
-            line = section[idx]
-            #print line
-            if line[0] !=" ": # end of region. exit
-                done = True
-                idx -= 1
-                #print "end region", len(section) - idx, line
+    rest = line.split()[1:]
+    pos = 0
+    while not rest and pos < len(body):
+        # addr, size on a following line, skipping "*(" input patterns
+        nl = body.find("\n", pos+1)
+        if nl < 0: nl = len(body)
+        data = body[pos:nl].split()
+        if data[0][:2] == "0x":
+            rest = data
+            body = body[:pos] + body[nl:]
+        elif data[0][:2] != "*(":
+            break
+        pos = nl
+    # extract addr, size if there
+    if rest:
+        if len(rest) == 2: # only addr, size
+            addr,size = rest
+        elif len(rest) > 2: # has attributes?
+            addr = rest[0]
+            if rest[1][:2] == "0x":
+                size = rest[1]
+                attr = rest[2:]
             else:
-                data = line.split()
-                body.append(data)
-                #print "storing", data
-        idx += 1
-    #
+                attr = rest[1:]
+        else:
+            addr = rest[0]
+    width = len(addr)-2 if addr else 8
+    region = Region(domain, name, addr and int(addr, 16), size and int(size, 16), width)
+    if attr:
+        process_attr(region, attr) # add attr to region
     # Parse now into a structure
-    body = process_region(body)
-    return body,idx
+    process_region(region, body)
+    return region
 
 ###--------------------------------------------
 ### Parse each section
@@ -535,32 +1265,19 @@ def parse_linker_memmap(section, verbose=DEBUG):
     regions = []  # store each symbol from mem map
     print " Parsing Linker and Mem map"
     # might start with .label OR 0xvalue, OR LOAD
-    symstart = False
-    idx = 0 # line counter
-    sym_addr = 0 # used to test if same symbol across lines
-    sym_domain = sym_value = None
-    sym_done = True
-    while idx < len(section):
-        s = section[idx] # iterate over lines in section
-        line = s.split()
-        #print "   ",line
-        if line[0][0] == "." or line[0][0] == "/": # region start
-            #print "\n.parsing region", line
-            region,idx = parse_region(section, idx)
+    for s, body in iter_top_level(section):
+        if s is None: # no top level line yet
+            pass
+        elif s[0] == "." or s[0] == "/": # region start
+            #print "\n.parsing region", s
+            region = parse_region(s, body)
             regions.append(region)
-            idx -= 1
             if verbose:
-##                print "  Saved", region[0][0],len(region)
-##                print "   ",region[0]
-##                if len(region)>2: print "   ",region[1]
-##                if len(region)>3: print "   ",region[2]
-##                if len(region)>4: print "   ",region[3]
-##                if len(region)>5: print "    ..."
-##                for i in range(min(6, len(region)-4),0,-1):
-##                    print "   ",region[-i]
                 print region
+            continue
         else:
-            # could be LOAD or mem loc
+            # could be LOAD
+            line = s.split()
             if line[0][:4] == 'LOAD':
                 loads.append(Linker_Load(line[1]))
                 #print "  LOAD", line
@@ -568,13 +1285,13 @@ def parse_linker_memmap(section, verbose=DEBUG):
                 pass
             elif line[0][:3] == 'END': #ignore groups
                 pass
-            else: # mem loc
-##                if verbose:
-##                    print "  mem loc:", line
-                assert int(line[0], 0)
-                mems.append(line)
-        #
-        idx += 1 
+        # or mem loc
+        for m in body.split("\n")[1:]:
+            line = m.split()
+##            if verbose:
+##                print "  mem loc:", line
+            assert int(line[0], 0)
+            mems.append(line)
     # 
     if verbose:
         print "  Loads: %d found. E.g." % len(loads)
@@ -593,28 +1310,19 @@ def parse_Output(section, verbose=DEBUG):
         - contains .ARM attributes, comments, and debug symbols
         - all as regions
     """
-    regions = [extract_output_dir(section[0][0])] # the output filename
-    idx = 1 # skip firstline
+    lines = iter(section)
+    title = next(lines) # first line is the output filename
+    regions = [extract_output_dir(title)]
     if verbose:
-        print " Parsing Output section", len(section), "bytes long"
-        print "  ", section[0][0]
-    while idx < len(section):
-        s = section[idx] # iterate over lines in section
+        print " Parsing Output section"
+        print "  ", title
+    for s, body in iter_top_level(lines):
         #print s
-        line = s.split()
-        if line[0][0] == ".": # start of new region
-            region,idx = parse_region(section, idx)
+        if s is not None and s[0] == ".": # start of new region
+            region = parse_region(s, body)
             regions.append(region)
-            idx -= 1
             if verbose:
                 print region
-##                # notneeded but helpful stopper
-##                print "   Saved", len(region)
-##                print "   ",region[0]
-##                if len(region)>6: print "    ..."
-##                for i in range(min(6, len(region)-1),0,-1):
-##                    print "   ",region[-i]
-        idx += 1
     #
     #print regions[0], len(regions)-1
     return regions
@@ -624,48 +1332,106 @@ def parse_cross_refs(section, verbose=DEBUG):
     """ Parse data in the "Cross Reference Table" section
         Expecting a sequence of:
          - 'Symbol', 'File'
-         - a symbol may have several files referenced.
-        Return list of each Symbol_name followed by it's files
+         - a symbol may have several files referenced, one per indented line
+         - a long symbol name has its first file on the next line
+        Return Cross_refs
     """
-    symbols = []
+    cross_refs = Cross_refs()
     print " Parsing Cross refs"
     first = True
-    sym_name = False
-    symbol = []
+    symbol = None
+    files = []
     for s in section:
-        line = s.strip().split()
         if first: # first line is labels. verify
-            assert line == ['Symbol', 'File']
+            assert s.split() == ['Symbol', 'File']
             first = False
-        else:
-            # data lines
-            #print len(line),line
-            if len(line) == 1: # file to append
-                #print "   ",symbol
-                if symbol:
-                    symbol.append(line[0])
-                else:
-                    print "Fail"
-            else: # sym and file (len 2)
-                assert len(line) == 2
-                # save prev one
-                if symbol:
-                    symbols.append(symbol)
-                symbol = line
-                
+        elif s[0] == " ": # file to append
+            if symbol:
+                files.append(s.strip())
+            else:
+                print "Fail"
+        else: # sym and (usually) file
+            # save prev one
+            if symbol:
+                cross_refs.add(symbol, files)
+            line = s.split(None, 1)
+            symbol = line[0]
+            files = line[1:]
     # do last one
-    symbols.append(symbol)
+    if symbol:
+        cross_refs.add(symbol, files)
     #
     if verbose:
-        print "  Cross refs", len(symbols)
-        print "   ",symbols[0]
-        if len(symbols)>6: print "    ..."
-        for i in range(min(6, len(symbols)-1),0,-1):
-            print "   ",symbols[-i]
-    return symbols
+        cross_refs.describe()
+    return cross_refs
             
 
             
+def parse_preamble(section, verbose=DEBUG):
+    """ Parse the archive members listed before the first section title
+        Expecting titles like "Archive member included because of file (symbol)"
+         - member, then its reason "file (symbol)" on the next line
+         - or both on one line when the member name is short
+        Return Archive_graph
+    """
+    archives = Archive_graph()
+    print " Parsing Preamble"
+    as_needed = False
+    member = None
+    for s in section:
+        if s[0] != " ":
+            if s.startswith(("Archive member included", "As-needed library included")):
+                as_needed = s.startswith("As-needed")
+                member = None
+                continue
+            line = s.split(None, 1)
+            member = line[0]
+            if len(line) == 1:
+                continue # reason on next line
+            reason = line[1]
+        elif member:
+            reason = s.strip()
+        else:
+            continue
+        # reason is file (symbol)
+        i = reason.find(" (")
+        sfile, symbol = reason[:i], reason[i+2:-1]
+        if as_needed:
+            archives.as_needed[member] = (sfile, symbol)
+        else:
+            archives.add(member, sfile, symbol)
+        member = None
+    #
+    if verbose:
+        print " ", archives
+    return archives
+
+
+def parse_discarded(section, verbose=DEBUG):
+    """ Parse data in the "Discarded input sections" section
+        Expecting input section lines like the linker memory map
+         - name addr size file. Long names put addr on the next line
+        Return Discard_stats. Lines are counted as they stream past
+    """
+    stats = Discard_stats()
+    print " Parsing Discarded input sections"
+    name = None
+    for s in section:
+        line = s.split()
+        if line[0][:2] != "0x":
+            name = line[0]
+            line = line[1:]
+        if len(line) >= 3 and line[1][:2] == "0x" and name:
+            # addr, size, file
+            stats.add(name, int(line[1], 16), " ".join(line[2:]))
+            name = None
+        # else name alone, or (size before relaxing)
+    #
+    if verbose:
+        stats.describe()
+    return stats
+
+
 def parse_mem_config(section, verbose=DEBUG):
     """ Parse data in the "Memory Configuration" section
         Expecting a sequence of:
@@ -685,7 +1451,7 @@ def parse_mem_config(section, verbose=DEBUG):
             attr = None
             if len(line) == 4:
                 attr = line[3]
-            blocks.append(Block(line[1], line[2], line[0], attr))
+            blocks.append(Block(int(line[1], 16), int(line[2], 16), line[0], attr, len(line[1])-2))
     #
     if verbose:
         for b in blocks: print " ",b
@@ -715,61 +1481,270 @@ def parse_common_symbols(section, verbose=DEBUG):
             elif not done:
                 # cont of prev line
                 assert len(line) == 2 # complete
-                symbols.append(Common_symbol(label, line[0], line[1]))
+                symbols.append(Common_symbol(label, int(line[0], 16), line[1]))
                 done = True
                 label = ""
             else: # full line
                 assert len(line) == 3
-                symbols.append(Common_symbol(*line))
+                symbols.append(Common_symbol(line[0], int(line[1], 16), line[2]))
     #
     if verbose:
         for s in symbols: print " ",s
     return symbols
 
 
+###-----------------------------------------------------
+### Cost of each parse phase
+
+PHASE_FIELDS = ["seconds", "lines", "objects", "regions", "symbols"]
+PHASE_NAMES = dict((label, name) for name, label in SECTION_NAMES.items())
+
+class Parse_stats(object):
+    """ Cost of each phase of parse_sections, when one is passed in
+        - a phase is the parse of one section, named as in SECTION_NAMES,
+          then "link" for linking the COMMON symbols
+        - seconds of wall time, lines of the section consumed,
+          objects left allocated (gc tracked, counted with the gc off),
+          Regions and symbol records added to the map
+        - lazy lines are counted as they are read, which adds to the seconds
+        - with cprofile the phases also run under cProfile
+        - adds up over every map parsed with it
+    """
+    def __init__(self, objects=True, cprofile=False):
+        self.objects = objects
+        self.profiler = cProfile.Profile() if cprofile else None
+        self.phases = [] # dict per phase of each map, in parse order
+        self.current = None
+    def __repr__(self):
+        return "<Parse_stats %d phases %.3fs>" % (len(self.phases), sum(p["seconds"] for p in self.phases))
+
+    @staticmethod
+    def produced(memmap):
+        " (regions, symbol records) in memmap "
+        regions = [r for b in memmap.blocks for r in b.regions]
+        return len(regions), sum(r.symbol_count() for r in regions)
+    def counted(self, lines):
+        " lines, counted into the current phase as they are read "
+        phase = self.current
+        for line in lines:
+            phase["lines"] += 1
+            yield line
+    def start(self, memmap, label, lines=()):
+        """ start timing the phase for label
+            Return lines, to be parsed in place of the originals
+        """
+        phase = self.current = {"system": memmap.system, "phase": PHASE_NAMES.get(label, label)}
+        if isinstance(lines, list):
+            phase["lines"] = len(lines)
+        else:
+            phase["lines"] = 0
+            lines = self.counted(lines)
+        phase["regions"], phase["symbols"] = self.produced(memmap)
+        if self.objects:
+            self.gc_enabled = gc.isenabled()
+            gc.disable() # a collection would untrack new tuples
+            phase["objects"] = len(gc.get_objects())
+        if self.profiler:
+            self.profiler.enable()
+        phase["seconds"] = time.time()
+        return lines
+    def stop(self, memmap):
+        " end the current phase "
+        taken = time.time()
+        if self.profiler:
+            self.profiler.disable()
+        phase = self.current
+        phase["seconds"] = taken - phase["seconds"]
+        if self.objects:
+            phase["objects"] = len(gc.get_objects()) - phase["objects"]
+            if self.gc_enabled:
+                gc.enable()
+        else:
+            phase["objects"] = None
+        regions, symbols = self.produced(memmap)
+        phase["regions"] = regions - phase["regions"]
+        phase["symbols"] = symbols - phase["symbols"]
+        self.phases.append(phase)
+        self.current = None
+
+    def totals(self):
+        " {phase: {field: total}} over every map "
+        totals = {}
+        for phase in self.phases:
+            total = totals.get(phase["phase"])
+            if total is None:
+                total = totals[phase["phase"]] = dict((f, 0) for f in PHASE_FIELDS)
+            for field in PHASE_FIELDS:
+                if phase[field] is not None:
+                    total[field] += phase[field]
+        return totals
+    def save(self, filename):
+        """ json of the phases and their totals
+            - or a cProfile dump, for pstats, if filename ends .prof
+        """
+        if filename.endswith(".prof"):
+            if not self.profiler:
+                raise ValueError("no cProfile data, make Parse_stats with cprofile=True")
+            self.profiler.dump_stats(filename)
+            return
+        with open(filename, 'w') as outf:
+            json.dump({"fields": PHASE_FIELDS, "phases": self.phases, "totals": self.totals()},
+                      outf, indent=1, sort_keys=True)
+    def describe(self, preamble=""):
+        print preamble + "Parse phases:"
+        print preamble + " %-24s %-10s %9s %9s %9s %8s %8s" % (("map", "phase") + tuple(PHASE_FIELDS))
+        for p in self.phases:
+            print preamble + " %-24s %-10s %8.1fms %9d %9s %8d %8d" % (p["system"][-24:], p["phase"],
+                1000 * p["seconds"], p["lines"], "-" if p["objects"] is None else p["objects"],
+                p["regions"], p["symbols"])
+
+
 ###-----------------------------------------------------
 ### Read the map file - gather into sections
-def read_map_file(filename, verbose=DEBUG):
-    """ Read the file into sections defined in SECTIONS
-        - for parsing in sep pass.
-        return as list of sections - of lines
+def iter_map_file(filename):
+    """ Stream the file as (label, line) pairs
+        - label is the SECTIONS name the line belongs to
+        - each section title line is tagged with its own section
+          (the Preamble has no title line)
+        - lines are right stripped, blank lines are dropped
     """
-    sections = {}
-    inf = open(filename, 'rU')
-    lines = inf.readlines()
-    print "%d lines read" % len(lines)
-    inf.close()
     # start with preamble section (first in SECTIONS)
     section_count = 0
     label = SECTIONS[section_count]
     next_label = SECTIONS[section_count+1]
     size = len(next_label)
-    section = []
-    # proceed through all sections gathering lines
-    for line in lines:
-        stripped = line.rstrip() # leave leading space for grouping
-        # Match the name in SECTIONS
-        if stripped[:size] == next_label:
-            # close section, move to next one
-            sections[label] = section
-            section_count += 1
-            label = SECTIONS[section_count]
-            # any more sections ?
-            if section_count < len(SECTIONS)-1:
-                next_label = SECTIONS[section_count+1]
-                size = len(next_label)
-            if label == 'OUTPUT': # special case this one
-                # also grab title line
-                section = [[stripped]]
+    inf = open(filename, 'rU')
+    try:
+        for line in inf:
+            stripped = line.rstrip() # leave leading space for grouping
+            # Match the name in SECTIONS
+            if next_label and stripped[:size] == next_label:
+                # move to next section
+                section_count += 1
+                label = next_label
+                # any more sections ?
+                if section_count < len(SECTIONS)-1:
+                    next_label = SECTIONS[section_count+1]
+                    size = len(next_label)
+                else:
+                    next_label = None
+                yield label, stripped
+            elif stripped:
+                yield label, stripped
+    finally:
+        inf.close()
+
+def iter_map_sections(filename):
+    """ Stream the file as (label, lines) pairs in file order
+        - lines is a lazy iterator over that section's lines
+          and must be consumed before moving to the next section
+        - title lines are dropped, except for OUTPUT which needs it
+        - sections missing from the file are not returned
+    """
+    for label, tagged in groupby(iter_map_file(filename), itemgetter(0)):
+        lines = (line for _, line in tagged)
+        if label != SECTIONS[0] and label != 'OUTPUT':
+            next(lines) # skip the title line
+        yield label, lines
+
+class Map_index(object):
+    """ Memory mapped map file with the byte range of each section
+        - one scan finds the title of each SECTIONS entry
+        - sections are handed out as zero-copy views or lazy lines
+          so a single section can be parsed without reading the rest
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        inf = open(filename, 'rb')
+        try:
+            if os.fstat(inf.fileno()).st_size:
+                self.data = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+            else: # cannot map an empty file
+                self.data = ""
+        finally:
+            inf.close()
+        self.ranges = {} # label: (start, end) byte offsets, title excluded
+        self.order = []  # labels in file order
+        self.scan()
+    def __repr__(self):
+        return "<Map_index %s %d sections>" % (self.filename, len(self.order))
+    def __contains__(self, label):
+        return label in self.ranges
+
+    def find_title(self, label, pos):
+        " byte offset of label at the start of a line, at or after pos "
+        data = self.data
+        found = data.find(label, pos)
+        while found > 0 and data[found-1] != "\n":
+            found = data.find(label, found+1)
+        return found
+    def scan(self):
+        """ find each title in SECTIONS order, as iter_map_file does
+            - a missing title stops the search for later ones
+        """
+        titles = [(SECTIONS[0], 0, 0)] # label, title start, body start
+        pos = 0
+        for label in SECTIONS[1:]:
+            found = self.find_title(label, pos)
+            if found < 0:
+                break
+            if label == 'OUTPUT': # keep title line, it holds the filename
+                body = found
             else:
-                section = []
-        else:
-            # still in this section, keep gathering data
-            if stripped:
-                section.append(stripped)
-    # gather the last one
-    sections[label] = section
-    #
+                body = self.data.find("\n", found)
+                body = len(self.data) if body < 0 else body+1
+            titles.append((label, found, body))
+            pos = body
+        ends = [t[1] for t in titles[1:]] + [len(self.data)]
+        for (label, start, body), end in zip(titles, ends):
+            if label == SECTIONS[0] and not self.data[:end].strip():
+                continue # no Preamble before the first title
+            self.ranges[label] = (body, end)
+            self.order.append(label)
+
+    def view(self, label):
+        " zero-copy buffer over the raw bytes of a section "
+        start, end = self.ranges[label]
+        return buffer(self.data, start, end-start)
+    def lines(self, label):
+        """ lazy iterator over a section's lines
+            - right stripped, blank lines dropped as in iter_map_file
+        """
+        data = self.data
+        pos, end = self.ranges[label]
+        while pos < end:
+            nl = data.find("\n", pos, end)
+            if nl < 0: nl = end
+            line = data[pos:nl].rstrip()
+            if line:
+                yield line
+            pos = nl+1
+    def sections(self, labels=None):
+        """ (label, lines) pairs in file order, as iter_map_sections
+            - optionally only those in labels
+        """
+        for label in self.order:
+            if labels is None or label in labels:
+                yield label, self.lines(label)
+    def close(self):
+        if self.data:
+            self.data.close()
+        self.data = ""
+        self.ranges = {}
+        self.order = []
+
+
+def read_map_file(filename, verbose=DEBUG):
+    """ Read the file into sections defined in SECTIONS
+        - for parsing in sep pass.
+        return as dict of sections - of lines
+    """
+    sections = {}
+    count = 0
+    for label, lines in iter_map_sections(filename):
+        sections[label] = list(lines)
+        count += len(sections[label])
+    print "%d lines read" % count
     print "For: %s.\n  Found %d sections.\n %s\nReading:" %(filename, len(sections), sections.keys())
     if verbose:
         for label in SECTIONS:
@@ -778,72 +1753,970 @@ def read_map_file(filename, verbose=DEBUG):
     return sections
 
 
-def parse_sections(extracted, name):
+def wanted_sections(names=None):
+    """ SECTIONS labels for a list of SECTION_NAMES
+        - None is the PARSED list
+        - regions need blocks to go into so they are added
+    """
+    names = set(PARSED if names is None else names)
+    if "linker" in names or "output" in names:
+        names.add("blocks")
+    return set(SECTION_NAMES[n] for n in names)
+
+def parse_sections(extracted, name, wanted=None, stats=None):
     """ Step through each of the sections
         - calling the parser for each one
+        - extracted is the dict from read_map_file
+          or (label, lines) pairs in file order from iter_map_sections
+        - wanted is the SECTIONS labels to parse, default all
+        - stats, a Parse_stats, records the cost of each section
         - ignore Preamble Section
-        - start with Blocks
+        - Blocks come before the Regions that go into them
         - load into the memorymap class
     """
+    if isinstance(extracted, dict):
+        extracted = [(label, extracted[label]) for label in SECTIONS if label in extracted]
     memmap = Memory_map(extract_system_name(name))
-    blocks = parse_mem_config(extracted[SECTIONS[3]])   # Memory Configuration
-    memmap.blocks = clean_blocks(blocks)
-    #print memmap
-    common_symbols = Common_symbols(parse_common_symbols(extracted[SECTIONS[1]])) # Common_Symbols
-    common_symbols.describe()
-    #  connect them - when pasing symbols ? !!
-    mem_data = parse_linker_memmap(extracted[SECTIONS[4]])  # Regions of Symbols
-    create_regions(memmap, mem_data) # insert into mem map
-    #memmap.describe()
-    outputs = parse_Output(extracted[SECTIONS[5]])  #
-    memmap.output_loc = outputs[0]
-    create_regions(memmap, outputs[1:])
-    if extracted.has_key(SECTIONS[6]):
-        cross_refs = parse_cross_refs(extracted[SECTIONS[6]]) # list of symbol names and ref_files
+    for label, lines in extracted:
+        if wanted is not None and label not in wanted:
+            continue # skipped unread
+        if stats is not None:
+            lines = stats.start(memmap, label, lines)
+        if label == SECTIONS[3]:   # Memory Configuration
+            blocks = parse_mem_config(lines)
+            memmap.blocks = clean_blocks(blocks)
+            #print memmap
+        elif label == SECTIONS[1]: # Common_Symbols
+            memmap.common_symbols = Common_symbols(parse_common_symbols(lines))
+        elif label == SECTIONS[4]: # Regions of Symbols
+            mem_data = parse_linker_memmap(lines)
+            create_regions(memmap, mem_data) # insert into mem map
+            #memmap.describe()
+        elif label == SECTIONS[5]: # OUTPUT
+            outputs = parse_Output(lines)
+            memmap.output_loc = outputs[0]
+            create_regions(memmap, outputs[1:])
+        elif label == SECTIONS[6]: # list of symbol names and ref_files
+            memmap.cross_refs = parse_cross_refs(lines)
+        elif label == SECTIONS[2]: # Discarded input sections
+            memmap.discarded = parse_discarded(lines)
+        elif label == SECTIONS[0]: # Archive members included
+            memmap.archives = parse_preamble(lines)
+        if stats is not None:
+            stats.stop(memmap)
+    if memmap.common_symbols:
+        if stats is not None:
+            stats.start(memmap, "link")
+        link_common_symbols(memmap, memmap.common_symbols)
+        if stats is not None:
+            stats.stop(memmap)
+    return memmap
+
+def sections_tag(sections):
+    " Parse_cache tag for a list of SECTION_NAMES "
+    if sections is None:
+        return ""
+    return "-" + "+".join(sorted(set(sections)))
+
+def parse_map_file(filename, mapped=False, cache=None, sections=None, verbose=DEBUG, stats=None):
+    """ Parse the map file as it is read, section by section
+        - the whole file is never held, but memory still grows with it:
+          each Region body is joined into one string while it is parsed
+          and every Region keeps its symbol records
+        - if mapped, read through a Map_index instead
+          which also avoids reading the unwanted sections
+        - if cache (a Parse_cache) use the result of an earlier parse
+        - sections is a list of SECTION_NAMES to parse, default PARSED
+        - stats, a Parse_stats, records the cost of each section
+        Return the Memory_map
+    """
+    tag = sections_tag(sections)
+    if cache:
+        memmap = cache.load(filename, tag)
+        if memmap:
+            if verbose: print "Cached:", filename
+            cache.save_index() # a touched file's new mtime
+            return memmap
+    name = os.path.basename(filename)
+    wanted = wanted_sections(sections)
+    if not mapped:
+        if verbose: print "Streaming:", filename
+        memmap = parse_sections(iter_map_sections(filename), name, wanted, stats)
+    else:
+        index = Map_index(filename)
+        if verbose: print "Mapped:", index
+        try:
+            memmap = parse_sections(index.sections(wanted), name, wanted, stats)
+        finally:
+            index.close()
+    if cache:
+        cache.store(filename, memmap, tag)
     return memmap
 
+def parse_worker(args):
+    """ parse_map_file in a worker process of parse_map_files
+        - module level so the Pool can pickle it
+    """
+    filename, mapped, sections = args
+    return parse_map_file(filename, mapped, sections=sections)
+
+def parse_map_files(filenames, jobs=None, mapped=False, cache=None, sections=None, verbose=DEBUG, stats=None):
+    """ Parse many map files, spread over jobs processes
+        - jobs None uses all the cpus, 1 parses in this process
+        - cached maps are loaded here, the rest parsed in the workers
+          and stored here so only one process writes the cache
+        - sections as for parse_map_file
+        - stats, a Parse_stats, parses in this process to record each section
+        Return list of Memory_maps in filenames order
+    """
+    tag = sections_tag(sections)
+    memmaps = [cache.load(f, tag) if cache else None for f in filenames]
+    todo = [i for i, m in enumerate(memmaps) if m is None]
+    if stats is not None:
+        jobs = 1
+    elif jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(todo))
+    if verbose: print "Parsing %d of %d maps in %d processes" % (len(todo), len(filenames), jobs)
+    args = [(filenames[i], mapped, sections) for i in todo]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            parsed = pool.map(parse_worker, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        parsed = [parse_map_file(f, m, sections=s, stats=stats) for f, m, s in args]
+    for i, memmap in zip(todo, parsed):
+        memmaps[i] = memmap
+        if cache:
+            cache.store(filenames[i], memmap, tag, tidy=False)
+    if cache:
+        if todo:
+            cache.evict() # once, it lists the whole cache
+        cache.save_index() # also when all hit, for touched files' new mtimes
+    return memmaps
+
+
 ###-------------------------------------
-### Exporting
+### Cache of parsed maps
+
+CACHE_VERSION = 6 # change when the parsed classes change
+
+def file_sha1(filename):
+    " sha1 hex digest of the file contents, read in chunks "
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as inf:
+        for chunk in iter(lambda: inf.read(1 << 20), ""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class Parse_cache(object):
+    """ On disk cache of parsed Memory_maps, pickled.
+        - keyed on a hash of the map file contents
+        - the hash is kept in an index by filename, size, mtime
+          so an unchanged file is not read again
+        - entries from another CACHE_VERSION are never loaded
+        - least recently used entries removed when over max_bytes
+    """
+    def __init__(self, directory=".mapcache", max_bytes=512*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index_file = os.path.join(directory, "index-v%d.pickle" % CACHE_VERSION)
+        self.index = {} # abspath: (size, mtime, hash)
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'rb') as inf:
+                    self.index = cPickle.load(inf)
+            except Exception:
+                pass # rebuilt as files are hashed
+        self.changed = False
+    def __repr__(self):
+        return "<Parse_cache %s %d files>" % (self.directory, len(self.index))
+
+    def file_hash(self, filename):
+        """ hash of the file contents
+            - from the index if size and mtime are unchanged
+        """
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        known = self.index.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            return known[2]
+        digest = file_sha1(filename)
+        self.index[path] = (stat.st_size, stat.st_mtime, digest)
+        self.changed = True
+        return digest
+    def entry(self, filename, tag=""):
+        " path of the cache entry for filename "
+        name = "%s%s-v%d.pickle" % (self.file_hash(filename), tag, CACHE_VERSION)
+        return os.path.join(self.directory, name)
+
+    def load(self, filename, tag=""):
+        """ Return cached Memory_map for filename or None
+            - tag separates differently parsed versions of a file
+        """
+        entry = self.entry(filename, tag)
+        try:
+            with open(entry, 'rb') as inf:
+                memmap = cPickle.load(inf)
+        except Exception: # missing, or unreadable
+            return None
+        os.utime(entry, None) # mark as recently used
+        # same contents may have another name
+        memmap.system = extract_system_name(os.path.basename(filename))
+        return memmap
+    def store(self, filename, memmap, tag="", tidy=True):
+        """ Save memmap as the entry for filename
+            - tidy False leaves evict and save_index to the caller,
+              once for a batch, see tidy
+        """
+        entry = self.entry(filename, tag)
+        temp = "%s.%d.tmp" % (entry, os.getpid())
+        with open(temp, 'wb') as outf:
+            cPickle.dump(memmap, outf, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp, entry) # so readers never see part of an entry
+        if tidy:
+            self.tidy()
+    def tidy(self):
+        " evict then save_index, after storing "
+        self.evict()
+        self.save_index()
+    def save_index(self):
+        " write the index, if file_hash changed it "
+        if not self.changed:
+            return
+        temp = "%s.%d.tmp" % (self.index_file, os.getpid())
+        with open(temp, 'wb') as outf:
+            cPickle.dump(self.index, outf, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp, self.index_file)
+        self.changed = False
+
+    def evict(self):
+        """ remove entries from other versions,
+            then oldest used until under max_bytes
+        """
+        current = "-v%d.pickle" % CACHE_VERSION
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith("index-"):
+                if name != os.path.basename(self.index_file):
+                    os.remove(path)
+                continue
+            if not name.endswith(current):
+                if not name.endswith(".tmp"): # may be being written
+                    os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+###-------------------------------------
+### Resolving addresses
+
+class Address_resolver(object):
+    """ Find the Block, Region, input section, label and file of many addresses
+        - sorted arrays of the loaded input sections and labels, searched
+          with bisect, or numpy.searchsorted for a whole batch if numpy is there
+        - the label is the nearest one at or below the address in its section
+        - merged sections listed at 0x0 are left out, see iter_placed_sections
+    """
+    def __init__(self, memmap):
+        self.system = memmap.system
+        self.block_index = Block_index(memmap.blocks)
+        regions = [] # (addr, end, name)
+        sections = [] # (addr, end, name, file, region)
+        labels = []
+        for b in memmap.blocks:
+            for r in b.regions:
+                if r.addr is None or not is_loaded(r):
+                    continue
+                regions.append((r.addr, r.addr + (r.size or 0), r.fullname()))
+                for name, addr, size, sfile in iter_placed_sections(r):
+                    if size:
+                        sections.append((addr, addr + size, name, sfile, r.fullname()))
+                labels.extend(l for l in iter_labels(r) if l[0] is not None)
+        regions.sort()
+        sections.sort()
+        labels.sort()
+        self.region_starts = [r[0] for r in regions]
+        self.region_ends = [r[1] for r in regions]
+        self.region_names = [r[2] for r in regions]
+        self.starts = [s[0] for s in sections]
+        self.ends = [s[1] for s in sections]
+        self.names = [s[2] for s in sections]
+        self.files = [s[3] for s in sections]
+        self.regions = [s[4] for s in sections]
+        self.label_starts = [l[0] for l in labels]
+        self.label_names = [l[1] for l in labels]
+        if numpy is not None:
+            self.np_starts = numpy.array(self.starts, dtype=numpy.uint64)
+            self.np_ends = numpy.array(self.ends, dtype=numpy.uint64)
+            self.np_label_starts = numpy.array(self.label_starts, dtype=numpy.uint64)
+    def __repr__(self):
+        return "<Address_resolver %s %d sections %d labels>" % (self.system, len(self.starts), len(self.label_starts))
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, addr):
+        " index of the input section holding addr, or -1 "
+        i = bisect_right(self.starts, addr) - 1
+        if i >= 0 and addr < self.ends[i]:
+            return i
+        return -1
+    def indices(self, addrs):
+        """ find for each of addrs (ints)
+            Return numpy array if numpy is there, else a list
+        """
+        if numpy is None:
+            find = self.find
+            return [find(a) for a in addrs]
+        addrs = numpy.asarray(addrs, dtype=numpy.uint64)
+        if not len(self.starts): # nothing for -1 to index
+            return numpy.full(len(addrs), -1, dtype=numpy.intp)
+        found = numpy.searchsorted(self.np_starts, addrs, side="right") - 1
+        # found -1 gathers the last end, masked out by found >= 0
+        hit = (found >= 0) & (addrs < self.np_ends[found])
+        return numpy.where(hit, found, -1)
+    def symbol_ids(self, addrs):
+        """ symbol of each of addrs (ints), -1 if not in an input section
+            - the nearest label in the section: len(self) + label index
+            - else the input section index
+            Return numpy array if numpy is there, else a list
+        """
+        count = len(self.starts)
+        if numpy is None:
+            find = self.find
+            label_starts = self.label_starts
+            found = []
+            for addr in addrs:
+                i = find(addr)
+                if i >= 0:
+                    j = bisect_right(label_starts, addr) - 1
+                    if j >= 0 and label_starts[j] >= self.starts[i]:
+                        i = count + j
+                found.append(i)
+            return found
+        addrs = numpy.asarray(addrs, dtype=numpy.uint64)
+        sections = self.indices(addrs)
+        if not self.label_starts or not self.starts:
+            return sections
+        labels = numpy.searchsorted(self.np_label_starts, addrs, side="right") - 1
+        in_label = (sections >= 0) & (labels >= 0) & \
+                   (self.np_label_starts[labels] >= self.np_starts[sections])
+        return numpy.where(in_label, count + labels, sections)
+    def symbol_table(self):
+        """ (name, file, region, size) of each symbol id of symbol_ids
+            - a label's size runs to the next label or the end of its section
+        """
+        table = [(self.names[i], self.files[i], self.regions[i], self.ends[i] - self.starts[i])
+                 for i in range(len(self.starts))]
+        starts = self.label_starts
+        for j, addr in enumerate(starts):
+            i = self.find(addr)
+            if i < 0:
+                table.append((self.label_names[j], None, self.region(addr), 0))
+                continue
+            end = self.ends[i]
+            if j + 1 < len(starts) and starts[j+1] < end:
+                end = starts[j+1]
+            table.append((self.label_names[j], self.files[i], self.regions[i], end - addr))
+        return table
+    def label(self, addr, index):
+        " nearest label at or below addr, inside input section index, or None "
+        j = bisect_right(self.label_starts, addr) - 1
+        if j >= 0 and self.label_starts[j] >= self.starts[index]:
+            return self.label_names[j]
+        return None
+    def region(self, addr):
+        " name of the Region holding addr, or None "
+        i = bisect_right(self.region_starts, addr) - 1
+        if i >= 0 and addr < self.region_ends[i]:
+            return self.region_names[i]
+        return None
+    def resolve(self, addrs):
+        """ [(addr, block, region, section, label, file)] for each of addrs
+            - names, or None where addr is outside them
+        """
+        addrs = list(addrs)
+        found = []
+        find_block = self.block_index.find
+        for addr, i in zip(addrs, self.indices(addrs)):
+            block = find_block(addr)
+            block = block.name if block else None
+            if i < 0:
+                found.append((addr, block, self.region(addr), None, None, None))
+            else:
+                found.append((addr, block, self.regions[i], self.names[i], self.label(addr, i), self.files[i]))
+        return found
+
+PROFILE_LEVELS = ["symbols", "objects", "regions"]
+
+class Profile(object):
+    """ Hit counts of PC samples, or call stacks, resolved against one map
+        - per symbol, object file and Region (PROFILE_LEVELS)
+        - flat counts the first address of each sample, the PC
+        - cumulative counts every symbol in a sample's stack, once per sample
+        - with numpy the counts are bincounts over the resolved ids
+    """
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.table = resolver.symbol_table()
+        self.samples = 0
+        self.missed = 0 # samples whose PC is in no input section
+        # level: list of names, and the id in it of each symbol
+        self.keys = {}
+        self.key_of = {}
+        for level, field in zip(PROFILE_LEVELS, (0, 1, 2)):
+            names = []
+            ids = {}
+            key_of = []
+            for i, entry in enumerate(self.table):
+                key = entry[field] if level != "symbols" else i
+                k = ids.get(key)
+                if k is None:
+                    k = ids[key] = len(names)
+                    names.append(key)
+                key_of.append(k)
+            self.keys[level] = names
+            self.key_of[level] = key_of
+        self.flat = dict((level, [0] * len(self.keys[level])) for level in PROFILE_LEVELS)
+        self.cumulative = dict((level, [0] * len(self.keys[level])) for level in PROFILE_LEVELS)
+    def __repr__(self):
+        return "<Profile %s %d samples>" % (self.resolver.system, self.samples)
+
+    def add(self, samples):
+        """ count samples, each a list of addresses, the PC first
+            - a single PC per sample is a flat profile
+        """
+        pcs = []
+        stack = [] # every address of every sample
+        owner = [] # its sample number
+        for sample in samples:
+            if not sample:
+                continue
+            pcs.append(sample[0])
+            stack.extend(sample)
+            owner.extend([self.samples + len(pcs)] * len(sample))
+        self.samples += len(pcs)
+        flat = self.resolver.symbol_ids(pcs)
+        ids = self.resolver.symbol_ids(stack)
+        if numpy is not None:
+            self.count_numpy(flat, ids, numpy.array(owner, dtype=numpy.int64))
+        else:
+            self.count_python(flat, ids, owner)
+    def count_python(self, flat, ids, owner):
+        self.missed += flat.count(-1)
+        for level in PROFILE_LEVELS:
+            key_of = self.key_of[level]
+            counts = self.flat[level]
+            for i in flat:
+                if i >= 0:
+                    counts[key_of[i]] += 1
+            counts = self.cumulative[level]
+            for pair in set((o, key_of[i]) for o, i in zip(owner, ids) if i >= 0):
+                counts[pair[1]] += 1
+    def count_numpy(self, flat, ids, owner):
+        self.missed += int((flat < 0).sum())
+        flat = flat[flat >= 0]
+        hit = ids >= 0
+        ids = ids[hit]
+        owner = owner[hit]
+        for level in PROFILE_LEVELS:
+            key_of = numpy.array(self.key_of[level], dtype=numpy.int64)
+            size = len(self.keys[level])
+            counts = numpy.bincount(key_of[flat], minlength=size)
+            self.flat[level] = [a + int(b) for a, b in zip(self.flat[level], counts)]
+            pairs = numpy.unique(owner * size + key_of[ids]) # once per sample
+            counts = numpy.bincount(pairs % size, minlength=size)
+            self.cumulative[level] = [a + int(b) for a, b in zip(self.cumulative[level], counts)]
+
+    def name(self, level, k):
+        " printable name of key k of level "
+        key = self.keys[level][k]
+        if level == "symbols":
+            name, sfile, region, size = self.table[key]
+            return "%s (%d bytes) %s" % (name, size, sfile)
+        return str(key)
+    def top(self, level, count=None, cumulative=False):
+        """ [(name, flat, cumulative)] of level with any hits, most first
+            - ranked by flat hits, or cumulative, then the other
+        """
+        flat = self.flat[level]
+        cum = self.cumulative[level]
+        if cumulative:
+            rank = lambda k: (-cum[k], -flat[k])
+        else:
+            rank = lambda k: (-flat[k], -cum[k])
+        ranked = sorted((k for k in range(len(flat)) if flat[k] or cum[k]), key=rank)
+        return [(self.name(level, k), flat[k], cum[k]) for k in ranked[:count]]
+    def describe(self, count=20, preamble=""):
+        """ top count of each level by flat hits
+            - and by cumulative hits, when the samples had callers
+        """
+        print preamble + "Profile %s: %d samples, %d outside the map" % (self.resolver.system, self.samples, self.missed)
+        total = float(self.samples or 1)
+        for level in PROFILE_LEVELS:
+            orders = [False]
+            if self.cumulative[level] != self.flat[level]:
+                orders.append(True)
+            for cumulative in orders:
+                print preamble + " %s by %s:    flat         cumulative" % (level, "cumulative" if cumulative else "flat")
+                for name, flat, cum in self.top(level, count, cumulative):
+                    print preamble + "  %8d %5.1f%% %8d %5.1f%%  %s" % (flat, 100*flat/total, cum, 100*cum/total, name)
+
+def read_samples(filename):
+    """ Yield the samples in filename, one per line
+        - the 0x words of the line, the PC first then its callers
+    """
+    with open(filename) as inf:
+        for line in inf:
+            sample = [int(word, 16) for word in HEX_WORD.findall(line)]
+            if sample:
+                yield sample
+
+def read_addresses(filename):
+    """ Yield the addresses (ints) in filename
+        - every 0x word, e.g. from a fault dump or a list of PC samples
+    """
+    with open(filename) as inf:
+        for line in inf:
+            for word in HEX_WORD.findall(line):
+                yield int(word, 16)
+
+
+###-------------------------------------
+### Database of builds
+
+BUILD_DB_SCHEMA = """
+create table if not exists builds (id integer primary key, hash text unique not null,
+    filename text, system text, mtime real, ingested real);
+create table if not exists blocks (build integer, name text, addr integer, size integer, used integer);
+create table if not exists regions (build integer, block text, name text, addr integer, size integer,
+    load_addr integer);
+create table if not exists symbols (id integer primary key, build integer, region text, name text,
+    addr integer, size integer, file text);
+create table if not exists labels (build integer, symbol integer, name text);
+create table if not exists objects (build integer, file text, size integer);
+create table if not exists common_symbols (build integer, name text, size integer, file text,
+    addr integer);
+create table if not exists xrefs (build integer, symbol text, file text, defines integer);
+create index if not exists builds_system on builds (system, mtime);
+create index if not exists blocks_build on blocks (build);
+create index if not exists regions_name on regions (name, build);
+create index if not exists symbols_build on symbols (build, region);
+create index if not exists symbols_name on symbols (name);
+create index if not exists labels_name on labels (name, build);
+create index if not exists objects_file on objects (file, build);
+create index if not exists common_name on common_symbols (name, build);
+create index if not exists xrefs_symbol on xrefs (symbol, build);
+create index if not exists xrefs_file on xrefs (file, build);
+"""
+
+SQLITE_MAX_INT = (1 << 63) - 1
+
+class Build_db(object):
+    """ SQLite history of parsed Memory_maps, one build per map file
+        - a build is keyed on the hash of its map file,
+          so ingesting the same file again does nothing
+        - tables: builds, blocks, regions, symbols, labels, objects,
+          common_symbols, xrefs. See BUILD_DB_SCHEMA
+        - builds are ordered by the map file mtime
+    """
+    def __init__(self, filename="builds.sqlite"):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(BUILD_DB_SCHEMA)
+    def __repr__(self):
+        return "<Build_db %s %d builds>" % (self.filename, len(self))
+    def __len__(self):
+        return self.db.execute("select count(*) from builds").fetchone()[0]
+    def close(self):
+        self.db.close()
+
+    def build_id(self, digest):
+        " id of the build with this file hash, or None "
+        row = self.db.execute("select id from builds where hash = ?", (digest,)).fetchone()
+        return row[0] if row else None
+    def ingest(self, filenames, jobs=None, mapped=False, cache=None, verbose=DEBUG):
+        """ Parse and store the map files not already in the db
+            - files with the same contents are parsed once,
+              the first of them names the build
+            Return list of build ids, in filenames order
+        """
+        digests = [cache.file_hash(f) if cache else file_sha1(f) for f in filenames]
+        ids = [self.build_id(d) for d in digests]
+        new = {} # digest: first index with it
+        for i, build in enumerate(ids):
+            if build is None and digests[i] not in new:
+                new[digests[i]] = i
+        new = sorted(new.values())
+        if verbose: print "Ingesting %d of %d maps" % (len(new), len(filenames))
+        memmaps = parse_map_files([filenames[i] for i in new], jobs, mapped, cache)
+        added = {} # digest: build id
+        for i, memmap in zip(new, memmaps):
+            added[digests[i]] = self.add(memmap, filenames[i], digests[i])
+        return [added[d] if build is None else build for d, build in zip(digests, ids)]
+    def add(self, memmap, filename, digest):
+        """ store memmap as the build of filename, in one transaction
+            Return the build id
+        """
+        with self.db:
+            build = self.db.execute("insert into builds (hash, filename, system, mtime, ingested) "
+                                    "values (?, ?, ?, ?, ?)",
+                                    (digest, filename, memmap.system,
+                                     os.path.getmtime(filename), time.time())).lastrowid
+            insert = self.db.execute
+            for b in memmap.blocks:
+                used = sum(r.size or 0 for r in b.regions if is_loaded(r))
+                # the *default* Block is 0xffffffffffffffff long, too big for SQLite
+                insert("insert into blocks values (?, ?, ?, ?, ?)",
+                       (build, b.name, b.addr, min(b.dur, SQLITE_MAX_INT), used))
+                for r in b.regions:
+                    name = r.fullname()
+                    insert("insert into regions values (?, ?, ?, ?, ?, ?)",
+                           (build, b.name, name, r.addr, r.size, r.load_addr))
+                    for sym in iter_symbols(r):
+                        symbol = insert("insert into symbols (build, region, name, addr, size, file) "
+                                        "values (?, ?, ?, ?, ?, ?)",
+                                        (build, name, sym.primary, sym.addr, sym.size,
+                                         sym.file if sym.fill is None else sym.fill_with)).lastrowid
+                        for addr, label in sym.labels:
+                            insert("insert into labels values (?, ?, ?)", (build, symbol, label))
+            self.db.executemany("insert into objects values (?, ?, ?)",
+                                ((build, f, size) for f, size in memmap.object_sizes().iteritems()))
+            if memmap.common_symbols:
+                self.db.executemany("insert into common_symbols values (?, ?, ?, ?, ?)",
+                                    ((build, cs.name, cs.size, cs.filename, cs.addr)
+                                     for cs in memmap.common_symbols.symbols))
+            if memmap.cross_refs:
+                self.db.executemany("insert into xrefs values (?, ?, ?, ?)",
+                                    ((build, symbol, f, i == 0)
+                                     for symbol, files in memmap.cross_refs.files.iteritems()
+                                     for i, f in enumerate(files)))
+        return build
+
+    def region_history(self, name, system=None, last=500):
+        """ [(filename, mtime, size)] of Region name in the last builds, oldest first
+            e.g. region_history(".bss", "stmhal")
+        """
+        rows = self.db.execute("select b.filename, b.mtime, sum(r.size) from builds b "
+                               "join regions r on r.build = b.id "
+                               "where r.name = ? and (? is null or b.system = ?) "
+                               "group by b.id order by b.mtime desc limit ?",
+                               (name, system, system, last)).fetchall()
+        return rows[::-1]
+    def label_history(self, name, system=None):
+        """ [(filename, mtime, size)] of the symbol holding label name, oldest first
+            - common symbols use their own size, others the input section size
+            e.g. label_history("mp_state_ctx")
+        """
+        return self.db.execute("select b.filename, b.mtime, coalesce(c.size, s.size) from builds b "
+                               "join labels l on l.build = b.id and l.name = ? "
+                               "join symbols s on s.id = l.symbol "
+                               "left join common_symbols c on c.build = b.id and c.name = l.name "
+                               "where (? is null or b.system = ?) order by b.mtime",
+                               (name, system, system)).fetchall()
+
+
+###-------------------------------------
+### Comparing two maps
+
+DIFF_LEVELS = ["blocks", "regions", "objects", "symbols"]
+
+def map_sizes(memmap):
+    """ Sizes of the parts of memmap, hashed by name, for diff_maps
+        - blocks: bytes used in each Block
+        - regions: (block, region) size
+        - objects: bytes from each input file
+        - symbols: (region, input section, file) size. Repeats are summed
+        Only loaded Regions are counted. *fill* is left out
+        - objects and symbols count the same input sections, see object_sizes
+        Return dict of level: {key: size}
+    """
+    blocks = {}
+    regions = {}
+    symbols = {}
+    for b in memmap.blocks:
+        used = 0
+        for r in b.regions:
+            if not is_loaded(r):
+                continue
+            name = r.fullname()
+            size = r.size or 0
+            regions[(b.name, name)] = regions.get((b.name, name), 0) + size
+            used += size
+            if is_reserved(r):
+                continue
+            for sname, addr, size, sfile in iter_placed_sections(r):
+                if sfile is not None and sname != "*fill*":
+                    key = (name, sname, sfile)
+                    symbols[key] = symbols.get(key, 0) + size
+        blocks[b.name] = blocks.get(b.name, 0) + used
+    return {"blocks": blocks, "regions": regions,
+            "objects": memmap.object_sizes(), "symbols": symbols}
+
+def diff_sizes(old, new):
+    """ Compare two dicts of key: size
+        Return added {key: size}, removed {key: size}, resized {key: (old, new)}
+    """
+    added = dict((k, v) for k, v in new.iteritems() if k not in old)
+    removed = dict((k, v) for k, v in old.iteritems() if k not in new)
+    resized = {}
+    for k, v in old.iteritems():
+        n = new.get(k)
+        if n is not None and n != v:
+            resized[k] = (v, n)
+    return added, removed, resized
+
+class Map_diff(object):
+    """ Changes from a reference Memory_map (the 100%) to another
+        - per level in DIFF_LEVELS: added, removed and resized items
+        - totals are the reference and new sizes of each level
+    """
+    def __init__(self, reference, other):
+        self.reference = reference.system
+        self.other = other.system
+        self.added = {}
+        self.removed = {}
+        self.resized = {}
+        self.totals = {}
+        old = map_sizes(reference)
+        new = map_sizes(other)
+        for level in DIFF_LEVELS:
+            self.added[level], self.removed[level], self.resized[level] = diff_sizes(old[level], new[level])
+            self.totals[level] = (sum(old[level].itervalues()), sum(new[level].itervalues()))
+    def __repr__(self):
+        return "<Map_diff %s to %s %s>" % (self.reference, self.other,
+                 " ".join("%s:+%d-%d~%d" % (l, len(self.added[l]), len(self.removed[l]), len(self.resized[l]))
+                          for l in DIFF_LEVELS))
+    def changes(self, level):
+        """ [(key, old size, new size)] of level, biggest change first
+            - old is None when added, new is None when removed
+        """
+        found = [(k, None, v) for k, v in self.added[level].iteritems()]
+        found.extend((k, v, None) for k, v in self.removed[level].iteritems())
+        found.extend((k, v[0], v[1]) for k, v in self.resized[level].iteritems())
+        found.sort(key=lambda c: (-abs((c[2] or 0) - (c[1] or 0)), c[0]))
+        return found
+    def describe(self, count=10, levels=DIFF_LEVELS, preamble=""):
+        print preamble + "Diff %s (100%%) to %s" % (self.reference, self.other)
+        for level in levels:
+            old, new = self.totals[level]
+            print preamble + " %s: %d to %d bytes (%+d, %.1f%%) added %d removed %d resized %d" % (
+                level, old, new, new - old, 100.0 * new / (old or 1),
+                len(self.added[level]), len(self.removed[level]), len(self.resized[level]))
+            for key, was, now in self.changes(level)[:count]:
+                name = key if isinstance(key, basestring) else " ".join(str(k) for k in key)
+                print preamble + "   %+8d  %8s -> %-8s %s" % ((now or 0) - (was or 0),
+                      "-" if was is None else was, "-" if now is None else now, name)
+
+def diff_maps(reference, other):
+    " Map_diff from reference (the 100%) to other "
+    return Map_diff(reference, other)
 
-# def collate_for(mem_map):
-    # """ Turn the Memmap class into a dictionary for json exporting
-    # """
-    # mem_dict = pass
-    
 
+###-------------------------------------
+### Symbols as columns
 
-def export_categories(filename, returned_cats, verbose=True):
+class Symbol_table(object):
+    """ The Symbols of Memory_maps as columns, one row per Symbol
+        - addr, size
+        - system, block, region, file: ids into the name lists
+          (file is -1 for *fill*)
+        - name: offset of the Symbol name in the names blob, NUL terminated
+        Columns are arrays, so they save to .npz without copying
+        - the file column is saved as file_id, numpy.savez takes file itself
     """
+    COLUMNS = ["addr", "size", "system", "block", "region", "file", "name"]
+    SAVED = {"file": "file_id"} # column: name in the .npz, where they differ
+    def __init__(self, memmaps=()):
+        wide = "L" if array("L").itemsize >= 8 else "d" # room for 64 bit addresses
+        self.addr = array(wide)
+        self.size = array(wide)
+        self.system = array("i")
+        self.block = array("i")
+        self.region = array("i")
+        self.file = array("i")
+        self.name = array("L")
+        self.systems = []
+        self.blocks = []
+        self.regions = []
+        self.files = []
+        self.names = [] # chunks of the names blob
+        self.ids = dict((names, {}) for names in ("systems", "blocks", "regions", "files"))
+        self.blob_size = 0
+        self.offsets = {} # name: offset in blob
+        for m in memmaps:
+            self.add(m)
+    def __repr__(self):
+        return "<Symbol_table %d symbols from %d maps>" % (len(self), len(self.systems))
+    def __len__(self):
+        return len(self.addr)
+    def id_of(self, names, name):
+        " index of name in the name list called names, appended if new "
+        ids = self.ids[names]
+        i = ids.get(name)
+        if i is None:
+            table = getattr(self, names)
+            i = ids[name] = len(table)
+            table.append(name)
+        return i
+    def offset_of(self, name):
+        " offset of name in the names blob, appended if new "
+        offset = self.offsets.get(name)
+        if offset is None:
+            offset = self.offsets[name] = self.blob_size
+            self.names.append(name + "\0")
+            self.blob_size += len(name) + 1
+        return offset
+    def add(self, memmap):
+        " append the Symbols of memmap, made one at a time "
+        system = self.id_of("systems", memmap.system)
+        for b in memmap.blocks:
+            block = self.id_of("blocks", b.name)
+            for r in b.regions:
+                region = self.id_of("regions", r.fullname())
+                for sym in iter_symbols(r):
+                    self.addr.append(sym.addr)
+                    self.size.append(sym.size)
+                    self.system.append(system)
+                    self.block.append(block)
+                    self.region.append(region)
+                    self.file.append(-1 if sym.file is None else self.id_of("files", sym.file))
+                    self.name.append(self.offset_of(sym.primary))
+    def blob(self):
+        " the names blob "
+        return "".join(self.names)
+    def columns(self):
+        """ dict of numpy arrays
+            - the name lists as string arrays and the names blob as uint8
+        """
+        if numpy is None:
+            raise ImportError("numpy is needed for Symbol_table.columns")
+        def as_numpy(col):
+            kind = "f" if col.typecode == "d" else ("u" if col.typecode.isupper() else "i")
+            return numpy.frombuffer(col, dtype="%s%d" % (kind, col.itemsize))
+        columns = dict((self.SAVED.get(name, name), as_numpy(getattr(self, name)))
+                       for name in self.COLUMNS)
+        for name in ("systems", "blocks", "regions", "files"):
+            columns[name] = numpy.array(getattr(self, name), dtype=str)
+        columns["names"] = numpy.frombuffer(self.blob(), dtype=numpy.uint8)
+        return columns
+    def save(self, filename):
+        """ write the columns to filename as .npz
+            - numpy.load(filename) gives them back
+        """
+        numpy.savez(filename, **self.columns())
+    @classmethod
+    def load(cls, filename):
+        " Symbol_table from a .npz written by save "
+        if numpy is None:
+            raise ImportError("numpy is needed for Symbol_table.load")
+        saved = numpy.load(filename)
+        try:
+            table = cls()
+            for name in cls.COLUMNS:
+                getattr(table, name).fromstring(saved[cls.SAVED.get(name, name)].tostring())
+            for names in ("systems", "blocks", "regions", "files"):
+                for name in saved[names]:
+                    table.id_of(names, str(name))
+            blob = saved["names"].tostring()
+        finally:
+            saved.close()
+        for name in blob.split("\0")[:-1]:
+            table.offset_of(name)
+        return table
+
+
+###-------------------------------------
+### Exporting
+
+### keys of the json export, and their compact versions
+JSON_KEYS = ["system", "output", "blocks", "name", "addr", "size", "attr", "regions",
+             "load_addr", "symbols", "file", "fill", "labels", "attributes"]
+JSON_COMPACT_KEYS = dict(zip(JSON_KEYS, ["sys", "o", "b", "n", "a", "s", "at", "r",
+                                         "la", "sy", "f", "fi", "l", "att"]))
+
+def write_json(outf, memmaps, compact=False):
+    """ Write the memmaps to outf as json: Blocks, their Regions, their Symbols
+        - written as it goes, one Symbol at a time, so memory use is constant
+        - compact uses short keys (JSON_COMPACT_KEYS), integer addresses and no spaces
+        - otherwise addresses are hex text as in the map file
+        - sizes are always integers
     """
-    if verbose: print "Summary"
+    if compact:
+        key = JSON_COMPACT_KEYS
+        address = lambda addr, width: addr
+        dumps = json.JSONEncoder(separators=(",", ":"), sort_keys=True).encode
+        nl = ""
+    else:
+        key = dict(zip(JSON_KEYS, JSON_KEYS))
+        address = hex_text
+        dumps = json.JSONEncoder(sort_keys=True).encode
+        nl = "\n"
+    open_list = '%s,"%s":[' if compact else '%s, "%s": ['
+    def head(fields, children):
+        " an object's fields (never empty), left open for its list of children "
+        return open_list % (dumps(fields)[:-1], key[children])
+    outf.write("[")
+    for i, m in enumerate(memmaps):
+        if i: outf.write(",")
+        outf.write(nl + head({key["system"]: m.system, key["output"]: m.output_loc}, "blocks"))
+        for j, b in enumerate(m.blocks):
+            if j: outf.write(",")
+            outf.write(nl + " " * bool(nl) + head({key["name"]: b.name,
+                                                   key["addr"]: address(b.addr, b.width),
+                                                   key["size"]: b.dur,
+                                                   key["attr"]: b.attr}, "regions"))
+            for k, r in enumerate(b.regions):
+                if k: outf.write(",")
+                fields = {key["name"]: r.fullname(),
+                          key["addr"]: address(r.addr, r.width),
+                          key["size"]: r.size}
+                if r.load_addr is not None:
+                    fields[key["load_addr"]] = address(r.load_addr, r.width)
+                outf.write(nl + "  " * bool(nl) + head(fields, "symbols"))
+                for n, sym in enumerate(iter_symbols(r)):
+                    fields = {key["name"]: sym.primary,
+                              key["addr"]: address(sym.addr, r.width),
+                              key["size"]: sym.size}
+                    if sym.file is not None:
+                        fields[key["file"]] = sym.file
+                    if sym.fill is not None:
+                        fields[key["fill"]] = sym.fill_with
+                    if sym.labels:
+                        fields[key["labels"]] = [[address(addr, r.width), label]
+                                                 for addr, label in sym.labels]
+                    if sym.attributes:
+                        fields[key["attributes"]] = sym.attributes
+                    outf.write(("," if n else "") + nl + "   " * bool(nl) + dumps(fields))
+                outf.write("]}")
+            outf.write("]}")
+        outf.write("]}")
+    outf.write(nl + "]" + nl)
+
+def export_json(filename, memmaps, compact=False):
+    " write_json to filename "
     outf = open(filename, 'w')
-    # title line
-    outf.write("%s, " % "system")
-    for c in CATS[:-1]: outf.write("%s, " %c)
-    outf.write("%s\n" % CATS[-1])
-    #for c in returned_cats: print c
-    for system, sysname in zip(returned_cats, maps):
-        outf.write("%s" % sysname[:sysname.find("_")])
-        if verbose: print sysname
-        for c in CATS:
-            found = False
-            for pair in system:
-                if c in pair:
-                    found = True
-                    if pair[1]:
-                        if verbose:
-                            value = int(pair[1],0)
-                        print "",c, pair, int(pair[1],0)
-                    else:
-                        value = 0
-                        if verbose:
-                            print "",c, pair, 0
-                    outf.write(",%s" % (value))
-            if not found:
-                outf.write(",%s" % (0))
-        outf.write('\n')
-        if verbose: print
-    outf.close()
+    try:
+        write_json(outf, memmaps, compact)
+    finally:
+        outf.close()
+
+
 
 def export_categories(filename, memmaps, regionlist):
     """ make CSV with on eline per mem_map of regions 
@@ -865,7 +2738,7 @@ def export_categories(filename, memmaps, regionlist):
             size = 0
             for f,s in data:
                 if f==name:
-                    size = int(s,16) if s else 0
+                    size = s or 0
                     break
             outf.write(",%s" % (size))
         outf.write('\n')
@@ -873,27 +2746,156 @@ def export_categories(filename, memmaps, regionlist):
         
     
 
-###
-if __name__ == "__main__":
-    collected_maps = [] # for json export
-    regionlist = CATS
-    maps = ["teensy_micropython_dh_01.map",
-            #"unix_micropython_dh_01.map",
-            "stmhal_firmware_dh_01.map",
-            "microbit-micropython_01.map"]
-    #maps = ["microbit-micropython_01.map"]
-    for m in maps:
-        extracted_data = read_map_file("mapfiles/"+m)
-        print "Parsing:"
-        mem_map = parse_sections(extracted_data, m)
-        print "  mem"
-        mem_map.describe()
-        collected_maps.append(mem_map)
-        # gather region info for v1 export
-        regionlist = mem_map.collect_region_names(regionlist)
-        #returned_cats.append(region_summary(mem_map[SECTIONS[4]]))
-        #collected_maps[m.system] = collate_for_json(m)
-        print
+def find_map_files(paths, pattern="*.map"):
+    """ Expand the paths into a list of map files
+        - a directory is searched recursively for pattern
+        - a glob is expanded, then treated as above
+        - files are taken as given. Duplicates removed
+    """
+    found = []
+    seen = set()
+    for path in paths:
+        matches = sorted(glob.glob(path)) if glob.has_magic(path) else [path]
+        for match in matches:
+            if os.path.isdir(match):
+                for root, dirs, files in os.walk(match):
+                    dirs.sort()
+                    for name in sorted(fnmatch.filter(files, pattern)):
+                        found.append(os.path.join(root, name))
+            else:
+                found.append(match)
+    unique = []
+    for f in found:
+        if f not in seen:
+            seen.add(f)
+            unique.append(f)
+    return unique
+
+
+### Defaults when no map files are given
+MAPFILES = ["mapfiles/teensy_micropython_dh_01.map",
+            #"mapfiles/unix_micropython_dh_01.map",
+            "mapfiles/stmhal_firmware_dh_01.map",
+            "mapfiles/microbit-micropython_01.map"]
+
+def main(argv=None):
+    """ Command line. Parse the map files and export them """
+    parser = argparse.ArgumentParser(description="Examine gcc .map files and export memory use")
+    parser.add_argument("paths", nargs="*", default=MAPFILES,
+                        help="map files, globs or directories (searched recursively)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="output file (default mappings.csv or mappings.json)")
+    parser.add_argument("-f", "--format", choices=["csv", "json"], default="csv",
+                        help="output format (default csv)")
+    parser.add_argument("--compact", action="store_true",
+                        help="json with short keys and integer addresses")
+    parser.add_argument("--npz", action="store_true",
+                        help="also save the symbols as numpy columns, next to the output (needs numpy)")
+    parser.add_argument("-p", "--pattern", default="*.map",
+                        help="file pattern when searching directories (default *.map)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="parallel processes (default one per cpu)")
+    parser.add_argument("--cache", metavar="DIR", default=None,
+                        help="keep parsed maps in this cache directory")
+    parser.add_argument("--cache-size", type=int, default=512,
+                        help="cache size limit in MB (default 512)")
+    parser.add_argument("--mapped", action="store_true",
+                        help="memory map the files instead of streaming them")
+    parser.add_argument("-s", "--sections", nargs="+", choices=sorted(SECTION_NAMES), metavar="NAME",
+                        help="sections to parse, from %s (default %s)" % (", ".join(sorted(SECTION_NAMES)), " ".join(PARSED)))
+    parser.add_argument("--db", metavar="FILE", default=None,
+                        help="ingest the maps into this SQLite build database, instead of exporting")
+    parser.add_argument("--phases", metavar="FILE", default=None,
+                        help="time each section of the parse, saved as json, or as a cProfile dump if FILE ends .prof")
+    parser.add_argument("-d", "--describe", action="store_true",
+                        help="print each parsed memory map")
+    parser.add_argument("--archives", type=int, metavar="N", default=None,
+                        help="report the N archive members costing most, and why each was linked")
+    parser.add_argument("--diff", type=int, metavar="N", default=None,
+                        help="compare each map to the first (the 100%%), top N changes per level")
+    parser.add_argument("--resolve", metavar="FILE", default=None,
+                        help="print Block, Region, symbol and file of the 0x addresses in FILE")
+    parser.add_argument("--profile", metavar="FILE", default=None,
+                        help="count PC samples in FILE per symbol, object and Region. One sample per line, PC first then callers")
+    parser.add_argument("--objects", type=int, metavar="N", default=None,
+                        help="text, data and bss of the N largest object files")
+    parser.add_argument("--tree", type=int, metavar="DEPTH", default=None,
+                        help="roll up object sizes by path, DEPTH levels down")
+    parser.add_argument("--fill", type=int, metavar="N", default=None,
+                        help="report alignment padding (*fill*), top N Regions and object files")
+    parser.add_argument("--gc-sections", type=int, metavar="N", default=None,
+                        help="report bytes discarded by --gc-sections, top N objects")
+    args = parser.parse_args(argv)
     #
-    export_categories("mappings.csv",collected_maps, regionlist)
+    maps = find_map_files(args.paths, args.pattern)
+    if not maps:
+        parser.error("no map files found")
+    missing = [m for m in maps if not os.path.isfile(m)]
+    if missing:
+        parser.error("not found: %s" % " ".join(missing))
+    if args.npz and numpy is None:
+        parser.error("--npz needs numpy")
+    cache = Parse_cache(args.cache, args.cache_size*1024*1024) if args.cache else None
+    if args.db:
+        db = Build_db(args.db)
+        ids = db.ingest(maps, args.jobs, args.mapped, cache, verbose=True)
+        if cache:
+            cache.save_index()
+        print "%d maps in %s" % (len(ids), db)
+        db.close()
+        return
+    print "Parsing:"
+    stats = Parse_stats(cprofile=args.phases.endswith(".prof")) if args.phases else None
+    collected_maps = parse_map_files(maps, args.jobs, args.mapped, cache, args.sections, stats=stats)
+    if stats:
+        stats.describe()
+        stats.save(args.phases)
+        print "Saved parse phases to", args.phases
+    for mem_map in collected_maps:
+        if args.describe:
+            print "  mem"
+            mem_map.describe()
+            #returned_cats.append(region_summary(mem_map[SECTIONS[4]]))
+            print
+        if args.archives is not None and mem_map.archives:
+            print mem_map.system
+            mem_map.archives.describe(mem_map.object_sizes(), args.archives, " ")
+        if args.resolve:
+            print mem_map.system
+            for found in Address_resolver(mem_map).resolve(read_addresses(args.resolve)):
+                print " %s %s %s %s %s %s" % ((hex_text(found[0]),) + found[1:])
+        if args.profile:
+            profile = Profile(Address_resolver(mem_map))
+            profile.add(read_samples(args.profile))
+            profile.describe()
+        if args.objects is not None:
+            mem_map.object_breakdown().describe(args.objects)
+        if args.tree is not None:
+            Path_trie(mem_map.object_breakdown()).describe(depth=args.tree)
+        if args.fill is not None:
+            mem_map.fill_stats().describe(args.fill)
+        if args.gc_sections is not None and mem_map.discarded:
+            print mem_map.system
+            mem_map.discarded.describe(args.gc_sections, " ")
+    if args.diff is not None:
+        for mem_map in collected_maps[1:]:
+            diff_maps(collected_maps[0], mem_map).describe(args.diff)
+    #
+    output = args.output or "mappings." + args.format
+    if args.format == "json":
+        export_json(output, collected_maps, args.compact)
+    else:
+        # gather region info for v1 export
+        regionlist = merge_orders([CATS] + [o for m in collected_maps for o in m.region_orders()])
+        export_categories(output, collected_maps, regionlist)
+    print "Exported %d maps to %s" % (len(collected_maps), output)
+    if args.npz:
+        columns = os.path.splitext(output)[0] + ".npz"
+        table = Symbol_table(collected_maps)
+        table.save(columns)
+        print "Saved %d symbols to %s" % (len(table), columns)
+
 
+###
+if __name__ == "__main__":
+    main()